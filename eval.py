@@ -73,6 +73,9 @@ def main(args):
     # load ema model instead
     print("Loading from EMA model ...")
     model.load_state_dict(checkpoint['state_dict_ema'])
+    if cfg['test_cfg']['script_heads']:
+        model.eval()
+        model.module.script_heads()
 
 
     # set up evaluator
@@ -95,6 +98,8 @@ def main(args):
         tb_writer=None,
         print_freq=args.print_freq,
         dataset = cfg['dataset_name'],
+        amp = cfg['test_cfg']['amp'],
+        async_postprocessing = cfg['test_cfg']['async_postprocessing'],
     )
     end = time.time()
     print("All done! Total time: {:0.2f} sec".format(end - start))
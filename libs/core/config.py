@@ -34,10 +34,17 @@ DEFAULTS = {
         # if true, force upsampling of the input features into a fixed size
         # only used for ActivityNet
         "force_upsampling": False,
+        # set to a folder to cache the decoded feats (fp16, C x T) on disk
+        # cached feats are memory-mapped instead of decoded at every epoch
+        "cache_folder": None,
     },
     "loader": {
         "batch_size": 8,
         "num_workers": 4,
+        # # batches loaded in advance by each worker (small to bound memory)
+        "prefetch_factor": 2,
+        # copy the batches into page-locked memory for faster transfers
+        "pin_memory": True,
     },
     # network architecture
     "model": {
@@ -70,6 +77,12 @@ DEFAULTS = {
         "head_kernel_size": 3,
         # if attach group norm to heads
         "head_with_ln": True,
+        # if the cls / reg heads of each modality share their conv trunk
+        # (the heads then only keep their output conv)
+        "head_share_trunk": False,
+        # if to overlap the audio backbone / neck with the visual ones on a
+        # cuda side stream
+        "audio_side_stream": False,
         # defines the max length of the buffered points
         "max_buffer_len_factor": 6.0,
         # disable abs position encoding (added to input embedding)
@@ -95,6 +108,19 @@ DEFAULTS = {
         "droppath": 0.1,
         # if to use label smoothing (>0.0)
         "label_smoothing": 0.0,
+        # if to use gradient checkpointing on the transformer blocks
+        # (less activation memory for longer max_seq_len, ~1 extra forward)
+        "use_checkpoint": False,
+        # if to run the forward pass under bf16 autocast (cuda)
+        "amp": False,
+        # if to allow TF32 for cuda matmuls / cudnn convs (Ampere or newer)
+        "allow_tf32": False,
+        # if to let cudnn autotune the conv kernels (faster, but the seeded
+        # runs are no longer bit-wise reproducible)
+        "cudnn_benchmark": False,
+        # torch.compile mode for the backbones / necks / heads (torch >= 2.2,
+        # single gpu), e.g., 'default' | 'reduce-overhead'; None to disable
+        "compile_mode": None,
     },
     "test_cfg": {
         "pre_nms_thresh": 0.001,
@@ -108,6 +134,18 @@ DEFAULTS = {
         "multiclass_nms": True,
         "ext_score_file": None,
         "voting_thresh" : 0.75,
+        # if to script + freeze the heads in eval.py (less python overhead)
+        "script_heads": False,
+        # if to run the network under bf16 autocast in eval.py (cuda),
+        # the decoding of the actions remains in fp32
+        "amp": False,
+        # if to compute / rank the verb x noun scores in bf16 (half the
+        # bytes of the T x (noun x verb) scores, scores rounded to ~3 digits),
+        # the segments are always decoded in fp32
+        "bf16_scores": False,
+        # if to run the cpu nms of a video on a worker thread in eval.py,
+        # overlapped with the forward pass of the next one (single gpu)
+        "async_postprocessing": False,
     },
     # optimizer (for training)
     "opt": {
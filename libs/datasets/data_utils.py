@@ -1,10 +1,7 @@
 import os
-import copy
 import random
 import numpy as np
-import random
 import torch
-from datetime import datetime
 
 def trivial_batch_collator(batch):
     """
@@ -21,37 +18,135 @@ def worker_init_reset_seed(worker_id):
     random.seed(seed)
     os.environ["PYTHONHASHSEED"] = str(seed)
 
-def truncate_feats(
-    data_dict,
+def window_intersect(segments, st, ed):
+    """
+    Intersect a truncation window [st, ed] with all segments (N x 2)
+    Return the clipped left / right boundaries and the ratio of each
+    segment that falls inside the window
+
+    segments: numpy array N x 2 (numpy ops are much cheaper than torch ops
+    on these tiny arrays)
+    """
+    left = np.maximum(segments[:, 0], st)
+    right = np.minimum(segments[:, 1], ed)
+    inter = np.maximum(right - left, 0)
+    area_segs = np.abs(segments[:, 1] - segments[:, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inter_ratio = inter / area_segs
+    return left, right, inter_ratio
+
+def sample_window_start(segments, feat_len, max_seq_len, trunc_thresh):
+    """
+    Sample the start of a truncation window with at least one action
+
+    For each segment (s, e), the window starts st that satisfy
+        min(st + max_seq_len, e) - max(st, s) >= trunc_thresh * (e - s)
+    form a contiguous range [s + trunc_thresh * (e - s) - max_seq_len,
+    e - trunc_thresh * (e - s)]. A prefix sum over these ranges counts the
+    covered segments at every candidate start, and a start is drawn uniformly
+    from the valid ones (same distribution as rejection sampling).
+
+    segments: numpy array N x 2 (in feature grid)
+    Return None if no valid start exists
+    """
+    max_st = feat_len - max_seq_len
+    seg_lens = segments[:, 1] - segments[:, 0]
+    need = trunc_thresh * np.abs(seg_lens)
+
+    # range of valid starts for each segment
+    lo = np.where(need > 0, np.ceil(segments[:, 0] + need - max_seq_len), 0)
+    hi = np.where(need > 0, np.floor(segments[:, 1] - need), max_st)
+    lo = np.clip(lo, 0, max_st + 1).astype(np.int64)
+    hi = np.clip(hi, -1, max_st).astype(np.int64)
+    # empty segments are never selected (inter_ratio = 0 / 0)
+    valid = (seg_lens != 0) & (lo <= hi) & (
+        (need == 0) | ((seg_lens >= need) & (need <= max_seq_len)))
+
+    # prefix sum -> # covered segments for each start
+    counts = np.zeros(max_st + 2, dtype=np.int64)
+    np.add.at(counts, lo[valid], 1)
+    np.add.at(counts, hi[valid] + 1, -1)
+    counts = np.cumsum(counts[:-1])
+
+    candidates = np.flatnonzero(counts > 0)
+    if candidates.size == 0:
+        return None
+    return int(candidates[random.randrange(candidates.size)])
+
+def search_window(
+    segments,
+    feat_len,
     max_seq_len,
     trunc_thresh,
-    seed,
-    crop_ratio=None,
     max_num_trials=200,
     has_action=True,
-    no_trunc=False
+    no_trunc=False,
+    num_candidates=32
 ):
     """
-    Truncate feats and time stamps in a dict item
+    Randomly search for a truncation window (rejection sampling)
 
-    data_dict = {'video_id'        : str
-                 'feats'           : Tensor C x T
-                 'segments'        : Tensor N x 2 (in feature grid)
-                 'labels'          : Tensor N
-                 'fps'             : float
-                 'feat_stride'     : int
-                 'feat_num_frames' : in
+    Candidates are drawn and scored in batches of num_candidates (one
+    K x N numpy op each), and the first valid one is kept. This bounds the
+    cost on hard videos to a few batched ops instead of up to
+    max_num_trials sequential trials.
 
+    segments: numpy array N x 2 (in feature grid)
+    Return (st, ed) of the last candidate if no valid window is found
     """
-    # get the meta info
-    feat_len = data_dict['feats_v'].shape[1]
-    num_segs = data_dict['segments'].shape[0]
+    if not (has_action or no_trunc):
+        # without any constraints
+        st = random.randint(0, feat_len - max_seq_len)
+        return st, st + max_seq_len
+
+    num_trials = 0
+    while num_trials < max_num_trials:
+        # sample a batch of random truncations of the video feats
+        num_cands = min(num_candidates, max_num_trials - num_trials)
+        num_trials += num_cands
+        sts = np.random.randint(0, feat_len - max_seq_len + 1, size=num_cands)
+        # K x 1 windows against N segments -> K x N ratios
+        wins = sts[:, None].astype(segments.dtype)
+        _, _, inter_ratio = window_intersect(segments, wins, wins + max_seq_len)
 
+        # only select those segments over the thresh
+        valid = (inter_ratio >= trunc_thresh).any(axis=1)
+        if no_trunc:
+            # with at least one action and not truncating any actions
+            valid &= ~((inter_ratio > 0.0) & (inter_ratio < 1.0)).any(axis=1)
+        # else: with at least one action
+
+        cand_idx = np.flatnonzero(valid)
+        if cand_idx.size > 0:
+            st = int(sts[cand_idx[0]])
+            return st, st + max_seq_len
+    st = int(sts[-1])
+    return st, st + max_seq_len
+
+def pick_window(
+    segments,
+    feat_len,
+    max_seq_len,
+    trunc_thresh,
+    crop_ratio=None,
+    max_num_trials=200,
+    has_action=True,
+    no_trunc=False
+):
+    """
+    Pick a truncation window using only the segments and the feat length,
+    such that the feats can be sliced before they are loaded
+
+    segments: Tensor N x 2 (in feature grid)
+    Return None if no truncation is needed, otherwise (st, ed, seg_idx, segments)
+    with seg_idx selecting the kept segments and segments their boundaries
+    clipped to and shifted by the window
+    """
     # seq_len < max_seq_len
     if feat_len <= max_seq_len:
         # do nothing
         if crop_ratio == None:
-            return data_dict
+            return None
         # randomly crop the seq by setting max_seq_len to a value in [l, r]
         else:
             max_seq_len = random.randint(
@@ -60,72 +155,69 @@ def truncate_feats(
             )
             # # corner case
             if feat_len == max_seq_len:
-                return data_dict
-
-    # otherwise, deep copy the dict
-    data_dict = copy.deepcopy(data_dict)
-
-    # try a few times till a valid truncation with at least one action
-    #print('==================================================')
-    #print(data_dict['video_id'])
-    #print(max_num_trials)
-    random_state = {}
-    for _ in range(max_num_trials):
-
-        # sample a random truncation of the video feats
-        #random.seed(6155645791486980374)
-        #if data_dict['video_id'] == 'P31_14':
+                return None
 
-        #print(data_dict['video_id'])
-        # x=random.getstate()
-        # np.save('./seed.npy', x)
+    # sample a valid truncation with at least one action in a single pass
+    segments_np = segments.numpy()
+    st = None
+    if has_action and (not no_trunc):
+        st = sample_window_start(
+            segments_np, feat_len, max_seq_len, trunc_thresh)
 
-
-        #x = np.load('./seed.npy', allow_pickle=True)
-        #random.setstate(x)
-
-        #random.seed(seed)
-        #random.seed(1234567891)
-        st = random.randint(0, feat_len - max_seq_len)
-        
-        #print(datetime.now())
-        #print(st)
+    if st is not None:
         ed = st + max_seq_len
-        window = torch.as_tensor([st, ed], dtype=torch.float32)
-
-        # compute the intersection between the sampled window and all segments
-        window = window[None].repeat(num_segs, 1)
-        left = torch.maximum(window[:, 0], data_dict['segments'][:, 0])
-        right = torch.minimum(window[:, 1], data_dict['segments'][:, 1])
-        inter = (right - left).clamp(min=0)
-        area_segs = torch.abs(
-            data_dict['segments'][:, 1] - data_dict['segments'][:, 0])
-        inter_ratio = inter / area_segs
+    else:
+        # otherwise, try a few times till a valid truncation
+        st, ed = search_window(
+            segments_np, feat_len, max_seq_len, trunc_thresh,
+            max_num_trials, has_action, no_trunc)
+
+    # only select those segments over the thresh
+    left, right, inter_ratio = window_intersect(segments_np, st, ed)
+    seg_idx = (inter_ratio >= trunc_thresh)
+    # segments: N x 2 in feature grids, shifted due to truncation
+    segments = np.stack((left[seg_idx], right[seg_idx]), axis=1) - st
+    return st, ed, torch.from_numpy(seg_idx), torch.from_numpy(segments)
 
-        # only select those segments over the thresh
-        seg_idx = (inter_ratio >= trunc_thresh)
+def truncate_feats(
+    data_dict,
+    max_seq_len,
+    trunc_thresh,
+    seed,
+    crop_ratio=None,
+    max_num_trials=200,
+    has_action=True,
+    no_trunc=False
+):
+    """
+    Truncate feats and time stamps in a dict item
 
-        if no_trunc:
-            # with at least one action and not truncating any actions
-            seg_trunc_idx = (inter_ratio > 0.0) & (inter_ratio < 1.0)
-            if (seg_idx.sum().item() > 0) and (seg_trunc_idx.sum().item() == 0):
-                break
-        elif has_action:
-            # with at least one action
-            if seg_idx.sum().item() > 0:
-                break
-        else:
-            # without any constraints
-            break
-    #print(random_state)
+    data_dict = {'video_id'        : str
+                 'feats'           : Tensor C x T
+                 'segments'        : Tensor N x 2 (in feature grid)
+                 'labels'          : Tensor N
+                 'fps'             : float
+                 'feat_stride'     : int
+                 'feat_num_frames' : in
+
+    """
+    window = pick_window(
+        data_dict['segments'], data_dict['feats_v'].shape[1], max_seq_len,
+        trunc_thresh, crop_ratio, max_num_trials, has_action, no_trunc
+    )
+    if window is None:
+        return data_dict
+    st, ed, seg_idx, segments = window
+
+    # shallow copy the dict, only the truncated fields are replaced
+    # (no need to deep copy the full feats before slicing them)
+    out_dict = dict(data_dict)
     # feats: C x T
-    data_dict['feats_v'] = data_dict['feats_v'][:, st:ed].clone()
-    data_dict['feats_a'] = data_dict['feats_a'][:, st:ed].clone()
-    # segments: N x 2 in feature grids
-    data_dict['segments'] = torch.stack((left[seg_idx], right[seg_idx]), dim=1)
-    # shift the time stamps due to truncation
-    data_dict['segments'] = data_dict['segments'] - st
-    # labels: N
-    data_dict['labels_v'] = data_dict['labels_v'][seg_idx].clone()
-    data_dict['labels_n'] = data_dict['labels_n'][seg_idx].clone()
-    return data_dict
+    out_dict['feats_v'] = data_dict['feats_v'][:, st:ed].contiguous()
+    out_dict['feats_a'] = data_dict['feats_a'][:, st:ed].contiguous()
+    # segments: N x 2 in feature grids (clipped and shifted)
+    out_dict['segments'] = segments
+    # labels: N (boolean indexing already returns a copy)
+    out_dict['labels_v'] = data_dict['labels_v'][seg_idx]
+    out_dict['labels_n'] = data_dict['labels_n'][seg_idx]
+    return out_dict
@@ -37,20 +37,29 @@ def make_dataset(name, is_training, split, seed, **kwargs):
 
 ##########################################################################################
 
-def make_data_loader(dataset, is_training, generator, batch_size, num_workers):
+def make_data_loader(dataset, is_training, generator, batch_size, num_workers,
+                     prefetch_factor=2, pin_memory=True, sampler=None):
     """
         A simple dataloder builder
+        (sampler: e.g., a DistributedSampler, which then does the shuffling)
     """
+    # keep the workers (and their copy of the dataset) alive across epochs
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = {'persistent_workers': True,
+                         'prefetch_factor': prefetch_factor}
     loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=batch_size,
         num_workers=num_workers,
         collate_fn=trivial_batch_collator,
         worker_init_fn=(worker_init_reset_seed if is_training else None),
-        shuffle=is_training,
+        shuffle=(is_training and sampler is None),
+        sampler=sampler,
         drop_last=is_training,
         generator=generator,
-        persistent_workers=True
+        pin_memory=pin_memory and torch.cuda.is_available(),
+        **worker_kwargs
     )
     return loader
 
@@ -1,13 +1,27 @@
 import os
+import sys
 import json
 import numpy as np
 
 import torch
+import torch.distributed as dist
 from torch.utils.data import Dataset
 from torch.nn import functional as F
 
 from .datasets import register_dataset
-from .data_utils import truncate_feats
+from .data_utils import pick_window
+
+def _mmap_load(filename):
+    # memory-map a .npy file (only the header is parsed, no copy)
+    return np.load(filename, mmap_mode='r')
+
+def _save_atomic(filename, array):
+    # write to a temp file and rename it into place, such that a cache file
+    # is either complete or missing (never half written)
+    tmp_filename = '{}.{:d}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as fid:
+        np.save(fid, array)
+    os.replace(tmp_filename, filename)
 
 @register_dataset("epic")
 class EpicKitchensDataset(Dataset):
@@ -32,7 +46,8 @@ class EpicKitchensDataset(Dataset):
         file_prefix,     # feature file prefix if any
         file_ext_v,        # feature file extension if any
         file_ext_a,        # feature file extension if any
-        force_upsampling # force to upsample to max_seq_len
+        force_upsampling, # force to upsample to max_seq_len
+        cache_folder=None # folder for cached (fp16, C x T) feats if any
     ):
         # file path
         assert os.path.exists(feat_folder_v) and os.path.exists(json_file)
@@ -47,6 +62,7 @@ class EpicKitchensDataset(Dataset):
         self.file_ext_v = file_ext_v
         self.file_ext_a = file_ext_a
         self.json_file = json_file
+        self.cache_folder = cache_folder
 
         # split / training mode
         self.split = split
@@ -78,7 +94,22 @@ class EpicKitchensDataset(Dataset):
 
         assert len(label_dict_v) <= num_classes_v + 1
         assert len(label_dict_n) <= num_classes_n
-        self.data_list = dict_db
+        # struct of arrays: the annotations of video i are the rows
+        # seg_starts[i]:seg_starts[i+1] of segments / labels_v / labels_n
+        # (segments already in feature grids, all as torch tensors)
+        self.ids = dict_db['ids']
+        self.fps = dict_db['fps']
+        self.durations = dict_db['durations']
+        self.seg_starts = dict_db['seg_starts']
+        self.segments = dict_db['segments']
+        self.labels_v = dict_db['labels_v']
+        self.labels_n = dict_db['labels_n']
+        # per-video tensor views, created once (None if not annotated)
+        self.video_annots = [
+            (self.segments[s:e], self.labels_v[s:e], self.labels_n[s:e])
+            if e > s else (None, None, None)
+            for s, e in zip(self.seg_starts[:-1].tolist(), self.seg_starts[1:].tolist())
+        ]
         self.label_dict_v = label_dict_v
         self.label_dict_n = label_dict_n
 
@@ -92,6 +123,10 @@ class EpicKitchensDataset(Dataset):
             'empty_label_ids_n': empty_label_ids_n
         }
 
+        # decode / downsample all feats once and cache them on disk
+        if self.cache_folder is not None:
+            self.prepare_cache()
+
     def find_empty_cls(self, label_dict, num_classes):
         # find categories with out a data sample
         if len(label_dict) == num_classes:
@@ -122,11 +157,19 @@ class EpicKitchensDataset(Dataset):
                     # if act['label'] == '-1':
                     #     print(act)
                     #     print(value['subset'])
+                    # intern the label strings, such that the lookups in the
+                    # second pass are (mostly) pointer compares
+                    act['label'] = sys.intern(act['label'])
+                    act['label_noun'] = sys.intern(act['label_noun'])
                     label_dict_v[act['label']] = act['label_id']
                     label_dict_n[act['label_noun']] = act['label_id_noun']
+        else:
+            label_dict_v = self.label_dict_v
+            label_dict_n = self.label_dict_n
 
         # fill in the db (immutable afterwards)
-        dict_db = tuple()
+        ids, fps_list, durations, num_acts_list = [], [], [], []
+        all_acts = []
         for key, value in json_db.items():
             # skip the video if not in the split
             if value['subset'].lower() not in self.split:
@@ -147,109 +190,159 @@ class EpicKitchensDataset(Dataset):
                 duration = 1e8
 
             # get annotations if available
-            if ('annotations' in value) and (len(value['annotations']) > 0):
-                num_acts = len(value['annotations'])
-                segments = np.zeros([num_acts, 2], dtype=np.float32)
-                labels_v = np.zeros([num_acts, ], dtype=np.int64)
-                labels_n = np.zeros([num_acts, ], dtype=np.int64)
-                for idx, act in enumerate(value['annotations']):
-                    segments[idx][0] = act['segment'][0]
-                    segments[idx][1] = act['segment'][1]
-                    labels_v[idx] = label_dict_v[act['label']]
-                    labels_n[idx] = label_dict_n[act['label_noun']]
-            else:
-                segments = None
-                labels = None
-            dict_db += ({'id': key,
-                         'fps' : fps,
-                         'duration' : duration,
-                         'segments' : segments,
-                         'labels_v' : labels_v,
-                         'labels_n' : labels_n
-            }, )
+            acts = value.get('annotations', [])
+            all_acts.extend(acts)
+            ids.append(key)
+            fps_list.append(fps)
+            durations.append(duration)
+            num_acts_list.append(len(acts))
+
+        seg_starts = np.zeros([len(ids) + 1, ], dtype=np.int64)
+        np.cumsum(num_acts_list, out=seg_starts[1:])
+
+        # gather all annotations of the split with a single pass each
+        num_acts = len(all_acts)
+        segments = np.fromiter(
+            (t for act in all_acts for t in act['segment'][:2]),
+            dtype=np.float32, count=2 * num_acts
+        ).reshape(-1, 2)
+        labels_v = np.fromiter(
+            (label_dict_v[act['label']] for act in all_acts),
+            dtype=np.int64, count=num_acts
+        )
+        labels_n = np.fromiter(
+            (label_dict_n[act['label_noun']] for act in all_acts),
+            dtype=np.int64, count=num_acts
+        )
+
+        # convert time stamps (in second) into temporal feature grids once
+        # ok to have small negative values here
+        fps_acts = np.repeat(np.asarray(fps_list, dtype=np.float32), num_acts_list)
+        feat_stride = self.feat_stride * self.downsample_rate
+        segments = (segments * fps_acts[:, None] - 0.5 * self.num_frames) / feat_stride
+
+        dict_db = {'ids'        : ids,
+                   'fps'        : np.asarray(fps_list, dtype=np.float64),
+                   'durations'  : np.asarray(durations, dtype=np.float64),
+                   'seg_starts' : seg_starts,
+                   'segments'   : torch.from_numpy(segments),
+                   'labels_v'   : torch.from_numpy(labels_v),
+                   'labels_n'   : torch.from_numpy(labels_n)}
 
         return dict_db, label_dict_v, label_dict_n
 
     def __len__(self):
-        return len(self.data_list)
+        return len(self.ids)
 
-    def __getitem__(self, idx):
-        # directly return a (truncated) data point (so it is very fast!)
-        # auto batching will be disabled in the subsequent dataloader
-        # instead the model will need to decide how to batch / preporcess the data
-        video_item = self.data_list[idx]
+    def _cache_files(self, video_id):
+        # cached feats depend on the downsampling rate
+        file_name = self.file_prefix + video_id + '_ds{:d}'.format(self.downsample_rate)
+        return (os.path.join(self.cache_folder, file_name + '_v.npy'),
+                os.path.join(self.cache_folder, file_name + '_a.npy'))
 
+    def _load_raw_feats(self, video_id):
         # load features
         filename_v = os.path.join(self.feat_folder_v,
-                                self.file_prefix + video_item['id'] + self.file_ext_v)
+                                self.file_prefix + video_id + self.file_ext_v)
         filename_a = os.path.join(self.feat_folder_a,
-                                self.file_prefix + video_item['id'] + self.file_ext_a)
+                                self.file_prefix + video_id + self.file_ext_a)
 
 
         with np.load(filename_v) as data_v:
-            feats_v = data_v['feats'].astype(np.float32)
+            feats_v = data_v['feats'].astype(np.float32, copy=False)
 
-        feats_a = np.load(filename_a).astype(np.float32)
+        # .npy feats are memory-mapped, they are cast once they are sliced
+        feats_a = _mmap_load(filename_a)
         # print('-----------------------------shape')
         # print(feats_v.shape)
         # print(feats_a.shape)
 
-        #feat contact
-        if feats_v.shape[0] - feats_a.shape[0] > 0:
-            feats_a =np.pad(feats_a,((0,1),(0,0)),'edge')
-        elif feats_v.shape[0] - feats_a.shape[0] < 0:
-            feats_a = feats_a[:feats_v.shape[0],:]
-        # print(feats_v.shape)
-        # print(feats_a.shape)
-            #feats_v =np.pad(feats_v,((0,1),(0,0)),'edge')
-        # feats = np.concatenate((feats_v, feats_a), axis=1)
-
         # deal with downsampling (= increased feat stride)
-        ####################### visual #####################
-        feats_v = feats_v[::self.downsample_rate, :]
-        feat_stride = self.feat_stride * self.downsample_rate
-        # T x C -> C x T
-        feats_v = torch.from_numpy(np.ascontiguousarray(feats_v.transpose()))
+        # T x C -> C x T (views, copied only once they are sliced)
+        num_feats = feats_v.shape[0]
+        feats_v = feats_v[::self.downsample_rate, :].transpose()
+        if feats_a.shape[0] >= num_feats:
+            # drop the extra audio feats
+            feats_a = feats_a[:num_feats:self.downsample_rate, :].transpose()
+        else:
+            # repeat the last audio feat (edge padding), gathered together
+            # with the downsampling in a single copy
+            rows = np.minimum(
+                np.arange(0, num_feats, self.downsample_rate), feats_a.shape[0] - 1)
+            feats_a = feats_a[rows].transpose()
+        return feats_v, feats_a
+
+    def _load_feats(self, video_id):
+        # C x T numpy arrays, memory-mapped if the feats are cached
+        if self.cache_folder is not None:
+            cache_v, cache_a = self._cache_files(video_id)
+            return _mmap_load(cache_v), _mmap_load(cache_a)
+        return self._load_raw_feats(video_id)
+
+    def prepare_cache(self):
+        """
+            Decode, downsample and transpose the feats of all videos once,
+            and save them as fp16 C x T arrays that can be memory-mapped.
+            With torch.distributed, only rank 0 writes the cache and the
+            other ranks wait for it
+        """
+        distributed = dist.is_available() and dist.is_initialized()
+        if (not distributed) or (dist.get_rank() == 0):
+            os.makedirs(self.cache_folder, exist_ok=True)
+            for video_id in self.ids:
+                cache_v, cache_a = self._cache_files(video_id)
+                if os.path.exists(cache_v) and os.path.exists(cache_a):
+                    continue
+                feats_v, feats_a = self._load_raw_feats(video_id)
+                _save_atomic(cache_v, np.ascontiguousarray(feats_v, dtype=np.float16))
+                _save_atomic(cache_a, np.ascontiguousarray(feats_a, dtype=np.float16))
+        if distributed:
+            dist.barrier()
+
+    def __getitem__(self, idx):
+        # directly return a (truncated) data point (so it is very fast!)
+        # auto batching will be disabled in the subsequent dataloader
+        # instead the model will need to decide how to batch / preporcess the data
+        video_id = self.ids[idx]
+        fps, duration = float(self.fps[idx]), float(self.durations[idx])
 
-        ####################### audio ####################
-        feats_a = feats_a[::self.downsample_rate, :]
+        # feats are not read (from cache) / copied until they are sliced
+        feats_v, feats_a = self._load_feats(video_id)
         feat_stride = self.feat_stride * self.downsample_rate
-        # T x C -> C x T
-        feats_a = torch.from_numpy(np.ascontiguousarray(feats_a.transpose()))
 
+        # segments (in feature grids) / labels are precomputed views of the db
+        segments, labels_v, labels_n = self.video_annots[idx]
 
-        # convert time stamp (in second) into temporal feature grids
-        # ok to have small negative values here
-        if video_item['segments'] is not None:
-            segments = torch.from_numpy(
-                (video_item['segments'] * video_item['fps']- 0.5 * self.num_frames) / feat_stride
+        # pick the truncation window during training using only the feat
+        # length and segments, such that only the window is loaded
+        if self.is_training and (segments is not None):
+            window = pick_window(
+                segments, feats_v.shape[1], self.max_seq_len,
+                self.trunc_thresh, self.crop_ratio
             )
-            labels_v = torch.from_numpy(video_item['labels_v'])
-            labels_n = torch.from_numpy(video_item['labels_n'])
-        else:
-            segments, labels = None, None
+            if window is not None:
+                st, ed, seg_idx, segments = window
+                feats_v, feats_a = feats_v[:, st:ed], feats_a[:, st:ed]
+                labels_v, labels_n = labels_v[seg_idx], labels_n[seg_idx]
+
+        # C x T, a single copy of the (truncated) feats
+        # cached feats stay in fp16 and are cast to fp32 by the model on device
+        feat_dtype = np.float16 if self.cache_folder is not None else np.float32
+        feats_v = torch.from_numpy(np.ascontiguousarray(feats_v, dtype=feat_dtype))
+        feats_a = torch.from_numpy(np.ascontiguousarray(feats_a, dtype=feat_dtype))
 
         # return a data dict
-        data_dict = {'video_id'        : video_item['id'],
+        data_dict = {'video_id'        : video_id,
                      'feats_v'           : feats_v,      # C x T
                      'feats_a'           : feats_a,      # C x T
                      'segments'        : segments,   # N x 2
                      'labels_v'          : labels_v,     # N
                      'labels_n'          : labels_n,     # N
-                     'fps'             : video_item['fps'],
-                     'duration'        : video_item['duration'],
+                     'fps'             : fps,
+                     'duration'        : duration,
                      'feat_stride'     : feat_stride,
                      'feat_num_frames' : self.num_frames}
 
-        # truncate the features during training
-        if self.is_training and (segments is not None):
-            #print('+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==')
-            #print(data_dict['video_id'])
-            #print(idx)        
-            data_dict = truncate_feats(
-                data_dict, self.max_seq_len, self.trunc_thresh, self.seed, self.crop_ratio
-            )
-
         # print('+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++==')
         # print(data_dict['video_id'])
         # print(len(data_dict['labels_v']))
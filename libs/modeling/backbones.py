@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .models import register_backbone
 from .blocks import (get_sinusoid_encoding, TransformerBlock, MaskedConv1D,
@@ -28,10 +29,12 @@ class ConvTransformerBackbone(nn.Module):
         path_pdrop = 0.0,      # droput rate for drop path
         use_abs_pe = False,    # use absolute position embedding
         use_rel_pe = False,    # use relative position embedding
+        use_checkpoint = False, # recompute transformer blocks in backward to save memory
     ):
         super().__init__()
         assert len(arch) == 3
         assert len(mha_win_size) == (1 + arch[2])
+        self.use_checkpoint = use_checkpoint
         self.arch = arch
         self.mha_win_size = mha_win_size
         self.max_len = max_len
@@ -102,6 +105,13 @@ class ConvTransformerBackbone(nn.Module):
             if module.bias is not None:
                 torch.nn.init.constant_(module.bias, 0.)
 
+    def _run_block(self, block, x, mask):
+        # gradient checkpointing: only the block inputs are stored, the
+        # activations inside the block are recomputed during backward
+        if self.use_checkpoint and self.training and x.requires_grad:
+            return checkpoint(block, x, mask, use_reentrant=False)
+        return block(x, mask)
+
     def forward(self, x, mask):
         # x: batch size, feature channel, sequence length,
         # mask: batch size, 1, sequence length (bool)
@@ -131,22 +141,20 @@ class ConvTransformerBackbone(nn.Module):
 
         # stem transformer
         for idx in range(len(self.stem)):
-            x, mask = self.stem[idx](x, mask)
+            x, mask = self._run_block(self.stem[idx], x, mask)
 
         # prep for outputs
-        out_feats = tuple()
-        out_masks = tuple()
         # 1x resolution
-        out_feats += (x, )
-        out_masks += (mask, )
+        out_feats = [x]
+        out_masks = [mask]
 
         # main branch with downsampling
         for idx in range(len(self.branch)):
-            x, mask = self.branch[idx](x, mask)
-            out_feats += (x, )
-            out_masks += (mask, )
+            x, mask = self._run_block(self.branch[idx], x, mask)
+            out_feats.append(x)
+            out_masks.append(mask)
 
-        return out_feats, out_masks
+        return tuple(out_feats), tuple(out_masks)
 
 @register_backbone("conv")
 class ConvBackbone(nn.Module):
@@ -222,16 +230,14 @@ class ConvBackbone(nn.Module):
             x, mask = self.stem[idx](x, mask)
 
         # prep for outputs
-        out_feats = tuple()
-        out_masks = tuple()
         # 1x resolution
-        out_feats += (x, )
-        out_masks += (mask, )
+        out_feats = [x]
+        out_masks = [mask]
 
         # main branch with downsampling
         for idx in range(len(self.branch)):
             x, mask = self.branch[idx](x, mask)
-            out_feats += (x, )
-            out_masks += (mask, )
+            out_feats.append(x)
+            out_masks.append(mask)
 
-        return out_feats, out_masks
+        return tuple(out_feats), tuple(out_masks)
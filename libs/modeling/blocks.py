@@ -7,6 +7,57 @@ from torch import nn
 from .weight_init import trunc_normal_
 
 
+class QuantConv1d(nn.Module):
+    """
+    int8 dynamically quantized version of a Conv1d (stride 1, cpu inference)
+    The K taps are computed by a single quantized linear layer and summed up
+    with shifts (the dynamically quantized convs are much less accurate)
+    """
+    def __init__(self, conv):
+        super().__init__()
+        kernel_size = conv.kernel_size[0]
+        assert conv.stride[0] == 1 and conv.dilation[0] == 1 and conv.groups == 1
+        assert conv.padding[0] == kernel_size // 2
+        try:
+            import torch.ao.nn.quantized.dynamic as nnqd
+        except ImportError:
+            # torch < 1.13
+            import torch.nn.quantized.dynamic as nnqd
+        from torch.ao.quantization import default_dynamic_qconfig
+
+        self.kernel_size = kernel_size
+        self.padding = conv.padding
+        self.out_channels = conv.out_channels
+        # C_out x C_in x K -> K C_out x C_in (one block of rows per tap)
+        linear = nn.Linear(conv.in_channels, kernel_size * conv.out_channels, bias=False)
+        linear.weight.data.copy_(
+            conv.weight.data.permute(2, 0, 1).reshape(-1, conv.in_channels))
+        linear.qconfig = default_dynamic_qconfig
+        self.linear = nnqd.Linear.from_float(linear)
+        # the bias remains in fp32
+        self.bias = None
+        if conv.bias is not None:
+            self.bias = conv.bias.detach().clone()
+
+    def forward(self, x):
+        # x: B, C, T -> taps: B, T, K, C_out
+        B, _, T = x.size()
+        taps = self.linear(x.transpose(1, 2)).view(
+            B, T, self.kernel_size, self.out_channels)
+        pad = self.kernel_size // 2
+        out = taps[:, :, pad].clone()
+        # out[t] += taps_k[t + k - pad] (zero padding at both ends)
+        for k in range(self.kernel_size):
+            shift = k - pad
+            if shift < 0:
+                out[:, -shift:] += taps[:, :shift, k]
+            elif shift > 0:
+                out[:, :-shift] += taps[:, shift:, k]
+        if self.bias is not None:
+            out += self.bias
+        return out.transpose(1, 2)
+
+
 class MaskedConv1D(nn.Module):
     """
     Masked 1D convolution. Interface remains the same as Conv1d.
@@ -35,6 +86,10 @@ class MaskedConv1D(nn.Module):
         if bias:
             torch.nn.init.constant_(self.conv.bias, 0.)
 
+    def quantize_dynamic(self):
+        # swap the conv for an int8 one (cpu inference only)
+        self.conv = QuantConv1d(self.conv)
+
     def forward(self, x, mask):
         # x: batch size, feature channel, sequence length,
         # mask: batch size, 1, sequence length (bool)
@@ -47,18 +102,15 @@ class MaskedConv1D(nn.Module):
         # compute the mask
         if self.stride > 1:
             # downsample the mask using nearest neighbor
-            out_mask = F.interpolate(
-                mask.float(),
-                size=T//self.stride,
-                mode='nearest'
-            )
+            # (= strided slicing, as T is divisible by stride)
+            out_mask = mask[:, :, ::self.stride]
         else:
             # masking out the features
-            out_mask = mask.float()
+            out_mask = mask
 
-        # masking the output, stop grad to mask
-        out_conv = out_conv * out_mask.detach()
-        out_mask = out_mask.bool()
+        # masking the output (binary mask, in place on the conv output)
+        # the bool mask is promoted inside the multiply, no cast / copy needed
+        out_conv.mul_(out_mask)
         return out_conv, out_mask
 
 
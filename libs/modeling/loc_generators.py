@@ -53,6 +53,8 @@ class PointGenerator(nn.Module):
 
         # generate all points and buffer the list
         self.buffer_points = self._generate_points()
+        # last concatenation of the points over all levels (see concat)
+        self.concat_cache = None
 
     def _generate_points(self):
         points_list = []
@@ -87,3 +89,12 @@ class PointGenerator(nn.Module):
             pts = buffer_pts[:feat_len, :]
             pts_list.append(pts)
         return pts_list
+
+    def concat(self, pts_list):
+        # concat the points of all levels (F T x 4)
+        # the lengths are fixed during training (max_seq_len), such that the
+        # concatenation is cached and reused (the points are never modified)
+        key = (tuple(pts.shape[0] for pts in pts_list), pts_list[0].device)
+        if self.concat_cache is None or self.concat_cache[0] != key:
+            self.concat_cache = (key, torch.cat(pts_list, dim=0))
+        return self.concat_cache[1]
@@ -1,14 +1,14 @@
 import torch
 from torch.nn import functional as F
-from matplotlib import pyplot
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import MultipleLocator
+
+@torch.jit.script
 def sigmoid_focal_loss(
-    inputs,
-    targets,
-    reduction = 'none',
-    alpha = 0.25,
-    gamma = 2.0):
+    inputs: torch.Tensor,
+    targets: torch.Tensor,
+    reduction: str = 'none',
+    alpha: float = 0.25,
+    gamma: float = 2.0
+) -> torch.Tensor:
     """
     Loss used in RetinaNet for dense detection: https://arxiv.org/abs/1708.02002.
     Taken from
@@ -31,7 +31,11 @@ def sigmoid_focal_loss(
                  'sum': The output will be summed.
     Returns:
         Loss tensor with the reduction option applied.
+
+    Scripted such that the elementwise ops can be fused into fewer kernels.
     """
+    inputs = inputs.float()
+    targets = targets.float()
     p = torch.sigmoid(inputs)
     ce_loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
     p_t = p * targets + (1 - p) * (1 - targets)
@@ -51,6 +55,30 @@ def sigmoid_focal_loss(
     return loss
 
 
+@torch.jit.script
+def sigmoid_focal_loss_with_labels(
+    inputs: torch.Tensor,
+    labels: torch.Tensor,
+    label_smoothing: float = 0.0,
+    alpha: float = 0.25,
+    gamma: float = 2.0
+) -> torch.Tensor:
+    """
+    sigmoid_focal_loss (reduction='sum') of N x C logits against N integer
+    labels, where label C is the background (all zero targets).
+    The smoothed one-hot targets are built by a comparison with the class ids
+    (no F.one_hot + slice + in place updates), and the whole loss is scripted
+    such that the target construction is fused with the focal loss.
+    """
+    inputs = inputs.float()
+    num_classes = inputs.shape[-1]
+    classes = torch.arange(num_classes, device=inputs.device)
+    targets = (labels[:, None] == classes).to(inputs.dtype)
+    # optinal label smoothing
+    targets = targets * (1 - label_smoothing) + label_smoothing / (num_classes + 1)
+    return sigmoid_focal_loss(inputs, targets, 'sum', alpha, gamma)
+
+
 def ctr_giou_loss_1d(
     args,vid_idx,input_offsets, input_conf, input_actionness,
     target_offsets, target_start, target_end, target_action,
@@ -110,17 +138,16 @@ def ctr_giou_loss_1d(
 
     ############################# Gaussian lable #################################
     sigma2 = args.gau_sigma#*3
+    # scalar constant, folded outside of the tensor ops
+    inv_two_sigma2 = 1.0 / (2 * sigma2 * sigma2)
 
-    input_conf_s = torch.exp(torch.div(-torch.square(input_conf[:, 0]),2*sigma2*sigma2))
-    input_conf_e = torch.exp(torch.div(-torch.square(input_conf[:, 1]),2*sigma2*sigma2))
+    input_conf_s = torch.exp(input_conf[:, 0].square().mul(-inv_two_sigma2))
+    input_conf_e = torch.exp(input_conf[:, 1].square().mul(-inv_two_sigma2))
 
 
     iou_mask = (miouk > 0.5).float()#iou_mask = (miouk > 0.7).float()
-    loss_conf_s = torch.square(target_start.cuda() - input_conf_s).float()
-    loss_conf_s = torch.sum(loss_conf_s * iou_mask).float()
-
-    loss_conf_e = torch.square(target_end.cuda() - input_conf_e).float()
-    loss_conf_e = torch.sum(loss_conf_e * iou_mask).float()
+    loss_conf_s = ((target_start - input_conf_s).square() * iou_mask).sum().float()
+    loss_conf_e = ((target_end - input_conf_e).square() * iou_mask).sum().float()
     
     loss_conf = 0.5*loss_conf_s + 0.5*loss_conf_e
 
@@ -137,7 +164,7 @@ def ctr_giou_loss_1d(
     # print(input_actionness[0:100])
     # print(len(input_actionness[0]))
 
-    loss_action = torch.square(target_action.cuda() - input_actionness).float()
+    loss_action = torch.square(target_action - input_actionness).float()
     #loss_action = torch.mean(loss_action).float()
     loss_action = torch.mean(loss_action * iou_mask).float()
     ###############################################################################
@@ -225,30 +252,12 @@ def ctr_giou_loss_1d(
 
     # return loss
 def binary_logistic_loss(scores,anchors):
-    #p = torch.sigmoid(anchors)
-
-    anchors = anchors.squeeze(-1)
-    anchors = torch.sigmoid(anchors)
-
-    anchors = torch.flatten(anchors,0)
-    scores = torch.cat(scores,0)
-    # print(anchors[:10])
-    # print(scores[:10])
-    # print('--------------------actioness_loss')
-    # print(scores[:10])
-    # print(anchors[:10])
-
-    loss= torch.square(scores.cuda() - anchors).float()
-    loss= torch.sum(loss).float()
-    # print(len(anchors))
-    # #print(len(scores[0]))
-    # print(len(anchors[0]))
-    # #print(len(scores[0][0]))
-    # print(len(anchors[0][0]))
-    #print(len(anchors[0][0][0]))
-
-
-
+    # scores: flat target tensor (or a list of per-video targets)
+    # anchors: actionness logits, flattened to match the targets
+    anchors = torch.sigmoid(anchors.reshape(-1))
+    if isinstance(scores, (list, tuple)):
+        scores = torch.cat(scores, 0)
+    loss = F.mse_loss(anchors, scores.to(anchors.dtype), reduction='sum').float()
 
     # pmask=torch.can_cast(scores>0.5,dtype=torch.float32)
     # num_positive=torch.reduce_sum(pmask)
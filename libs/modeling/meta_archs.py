@@ -1,40 +1,153 @@
 import math
+import functools
+from typing import List, Tuple
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 
 from .models import register_meta_arch, make_backbone, make_neck, make_generator
-from .blocks import MaskedConv1D, Scale, LayerNorm
-from .losses import ctr_giou_loss_1d, sigmoid_focal_loss, binary_logistic_loss
-import json
-from ..utils import batched_nms
-from matplotlib import pyplot
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import MultipleLocator
-import numpy as np
+from .blocks import MaskedConv1D, LayerNorm
+from .losses import ctr_giou_loss_1d, sigmoid_focal_loss_with_labels, binary_logistic_loss
+from ..utils import batched_nms, batched_nms_device, HAS_DEVICE_NMS
 
+# fused scaled dot product attention (torch >= 2.0)
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
 
-class PtTransformerClsHeadV(nn.Module):
+
+def fuse_fpn_levels(
+    fpn_feats: List[torch.Tensor],
+    fpn_masks: List[torch.Tensor],
+    gap: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[Tuple[int, int]]]:
     """
-    1D Conv heads for classification
+    Concatenate all pyramid levels along time, such that a head runs each of
+    its convs once instead of once per level. Levels are separated by `gap`
+    masked out zero steps (kernel_size // 2), so that the convs see the same
+    zero padding at level boundaries as for separate levels.
+    Return the fused feats / masks, a float mask that zeros the gaps, and the
+    (start, end) of each level in the fused sequence
+    """
+    feats: List[torch.Tensor] = []
+    masks: List[torch.Tensor] = []
+    bounds: List[Tuple[int, int]] = []
+    start = 0
+    for cur_feat, cur_mask in zip(fpn_feats, fpn_masks):
+        if start > 0 and gap > 0:
+            # B x C x gap / B x 1 x gap
+            feats.append(cur_feat.new_zeros((cur_feat.shape[0], cur_feat.shape[1], gap)))
+            masks.append(cur_mask.new_zeros((cur_mask.shape[0], cur_mask.shape[1], gap)))
+            start += gap
+        feats.append(cur_feat)
+        masks.append(cur_mask)
+        bounds.append((start, start + cur_feat.shape[-1]))
+        start += cur_feat.shape[-1]
+    # 1 x 1 x T, zero on the gaps
+    keep = torch.zeros((1, 1, start), dtype=fpn_feats[0].dtype, device=fpn_feats[0].device)
+    for st, ed in bounds:
+        keep[:, :, st:ed] = 1.0
+    return torch.cat(feats, dim=-1), torch.cat(masks, dim=-1), keep, bounds
+
+@torch.jit.script
+def scale_relu(x: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    """
+    relu(scale * x) for the per-level scales of the reg / actionness heads,
+    scripted such that the multiply and the relu can be fused
+    """
+    return torch.clamp_min(x * scale, 0.0)
+
+@torch.jit.script
+def decode_segments(
+    pts: torch.Tensor,
+    offsets: torch.Tensor,
+    duration_thresh: float
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Decode the segments (N x 2) of points (N x 4, t / reg range / stride) and
+    their offsets (N x 2, normalized by the stride), and mask the segments
+    longer than duration_thresh. Scripted such that the elementwise ops can
+    be fused into fewer kernels
+    """
+    seg_left = pts[:, 0] - offsets[:, 0] * pts[:, 3]
+    seg_right = pts[:, 0] + offsets[:, 1] * pts[:, 3]
+    pred_segs = torch.stack((seg_left, seg_right), -1)
+    keep = (seg_right - seg_left) > duration_thresh
+    return pred_segs, keep
+
+@torch.jit.script
+def unravel_action_index(
+    idxs: torch.Tensor,
+    noun_topk: int,
+    verb_topk: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Unravel flat indices into a (points, noun_topk, verb_topk) score tensor
+    into point / noun rank / verb rank. The remainders are computed with a
+    multiply-subtract instead of fmod, scripted such that the integer ops
+    can be fused
+    """
+    num_cands = noun_topk * verb_topk
+    pt_idxs = torch.div(idxs, num_cands, rounding_mode='floor')
+    dx_loc = idxs - pt_idxs * num_cands
+    noun_idxs = torch.div(dx_loc, verb_topk, rounding_mode='floor')
+    verb_idxs = dx_loc - noun_idxs * verb_topk
+    return pt_idxs, noun_idxs, verb_idxs
+
+def merge_scale_keys(state_dict, prefix, fpn_levels):
+    """
+    Stack the per-level Scale params of old checkpoints (scale.{l}.scale)
+    into the (fpn_levels, ) scales param of the reg / actionness heads
+    """
+    keys = [prefix + 'scale.{:d}.scale'.format(l) for l in range(fpn_levels)]
+    if all(k in state_dict for k in keys):
+        state_dict[prefix + 'scales'] = torch.stack([state_dict.pop(k) for k in keys])
+
+def split_fpn_levels(x: torch.Tensor, bounds: List[Tuple[int, int]]) -> List[torch.Tensor]:
+    """
+    Split a fused sequence (see fuse_fpn_levels) back into pyramid levels
+    """
+    return [x[:, :, st:ed] for st, ed in bounds]
+
+def compact_fpn_levels(
+    x: torch.Tensor,
+    bounds: List[Tuple[int, int]]
+) -> Tuple[torch.Tensor, List[int]]:
+    """
+    Drop the gaps of a fused B x C x T sequence (see fuse_fpn_levels) and
+    transpose it in a single copy: B x C x T -> B x (sum T_l) x C (contiguous),
+    i.e., the layout of the losses / inference. Also return the level lengths
+    (the heads return both, split the levels only where they are needed)
+    """
+    xt = x.transpose(1, 2)
+    out = torch.cat([xt[:, st:ed] for st, ed in bounds], dim=1)
+    return out, [ed - st for st, ed in bounds]
+
+def expand_fpn_scales(scales: torch.Tensor, lens: List[int]) -> torch.Tensor:
+    """
+    Per-level scales (fpn_levels, ) -> per-step scales (sum T_l) x 1
+    """
+    return torch.cat([scales[l].expand(n) for l, n in enumerate(lens)])[:, None]
+
+
+class PtTransformerHeadTrunk(nn.Module):
+    """
+    Shared 1D Conv trunk (conv + LN + act layers) for the cls / reg heads
+    The heads on top only keep their output conv (num_layers=1)
     """
     def __init__(
         self,
         input_dim,
         feat_dim,
-        num_classes,
-        prior_prob=0.01,
         num_layers=3,
         kernel_size=3,
         act_layer=nn.ReLU,
-        with_ln=False,
-        empty_cls = []
+        with_ln=False
     ):
         super().__init__()
         self.act = act_layer()
+        self.padding = kernel_size // 2
 
-        # build the head
+        # build the trunk
         self.head = nn.ModuleList()
         self.norm = nn.ModuleList()
         for idx in range(num_layers-1):
@@ -59,43 +172,25 @@ class PtTransformerClsHeadV(nn.Module):
             else:
                 self.norm.append(nn.Identity())
 
-        # classifier
-        self.cls_head = MaskedConv1D(
-                feat_dim, 97, kernel_size,
-                stride=1, padding=kernel_size//2
-            )
-
-        # use prior in model initialization to improve stability
-        # this will overwrite other weight init
-        bias_value = -(math.log((1 - prior_prob) / prior_prob))
-        torch.nn.init.constant_(self.cls_head.conv.bias, bias_value)
-
-        # a quick fix to empty categories:
-        # the weights assocaited with these categories will remain unchanged
-        # we set their bias to a large negative value to prevent their outputs
-        empty_cls = []
-        if len(empty_cls) > 0:
-            bias_value = -(math.log((1 - 1e-6) / 1e-6))
-            for idx in empty_cls:
-                torch.nn.init.constant_(self.cls_head.conv.bias[idx], bias_value)
-
-    def forward(self, fpn_feats, fpn_masks):
+    def forward(
+        self,
+        fpn_feats: List[torch.Tensor],
+        fpn_masks: List[torch.Tensor]
+    ) -> List[torch.Tensor]:
         assert len(fpn_feats) == len(fpn_masks)
 
-        # apply the classifier for each pyramid level
-        out_logits = tuple()
-        for _, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)):
-            cur_out = cur_feat
-            for idx in range(len(self.head)):
-                cur_out, _ = self.head[idx](cur_out, cur_mask)
-                cur_out = self.act(self.norm[idx](cur_out))
-            cur_logits, _ = self.cls_head(cur_out, cur_mask)
-            out_logits += (cur_logits, )
+        # apply the trunk to all pyramid levels at once
+        cur_out, cur_mask, keep, bounds = fuse_fpn_levels(
+            fpn_feats, fpn_masks, self.padding)
+        for head, norm in zip(self.head, self.norm):
+            cur_out, _ = head(cur_out, cur_mask)
+            # re-zero the gaps between levels (LayerNorm adds its bias)
+            cur_out = self.act(norm(cur_out)) * keep
 
         # fpn_masks remains the same
-        return out_logits
+        return split_fpn_levels(cur_out, bounds)
 
-class PtTransformerClsHeadN(nn.Module):
+class PtTransformerClsHead(nn.Module):
     """
     1D Conv heads for classification
     """
@@ -109,7 +204,7 @@ class PtTransformerClsHeadN(nn.Module):
         kernel_size=3,
         act_layer=nn.ReLU,
         with_ln=False,
-        empty_cls = []
+        empty_cls=()
     ):
         super().__init__()
         self.act = act_layer()
@@ -141,7 +236,7 @@ class PtTransformerClsHeadN(nn.Module):
 
         # classifier
         self.cls_head = MaskedConv1D(
-                feat_dim, 300, kernel_size,
+                feat_dim, num_classes, kernel_size,
                 stride=1, padding=kernel_size//2
             )
 
@@ -155,26 +250,31 @@ class PtTransformerClsHeadN(nn.Module):
         # we set their bias to a large negative value to prevent their outputs
         if len(empty_cls) > 0:
             bias_value = -(math.log((1 - 1e-6) / 1e-6))
-            for idx in empty_cls:
-                torch.nn.init.constant_(self.cls_head.conv.bias[idx], bias_value)
+            with torch.no_grad():
+                self.cls_head.conv.bias.index_fill_(
+                    0, torch.as_tensor(empty_cls, dtype=torch.long), bias_value)
 
-    def forward(self, fpn_feats, fpn_masks):
+    def forward(
+        self,
+        fpn_feats: List[torch.Tensor],
+        fpn_masks: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, List[int]]:
         assert len(fpn_feats) == len(fpn_masks)
 
-        # apply the classifier for each pyramid level
-        out_logits = tuple()
-        for _, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)):
-            cur_out = cur_feat
-            for idx in range(len(self.head)):
-                cur_out, _ = self.head[idx](cur_out, cur_mask)
-                cur_out = self.act(self.norm[idx](cur_out))
-            cur_logits, _ = self.cls_head(cur_out, cur_mask)
-            out_logits += (cur_logits, )
+        # apply the classifier to all pyramid levels at once
+        cur_out, cur_mask, keep, bounds = fuse_fpn_levels(
+            fpn_feats, fpn_masks, self.cls_head.conv.padding[0])
+        for head, norm in zip(self.head, self.norm):
+            cur_out, _ = head(cur_out, cur_mask)
+            # re-zero the gaps between levels (LayerNorm adds its bias)
+            cur_out = self.act(norm(cur_out)) * keep
+        cur_logits, _ = self.cls_head(cur_out, cur_mask)
+        # B x C x T -> B x T x C once for all levels (the layout of the losses / inference)
+        # B x (sum T_i) x C, and the level lengths T_i
+        cur_logits, lens = compact_fpn_levels(cur_logits, bounds)
 
         # fpn_masks remains the same
-        return out_logits
-
-
+        return cur_logits, lens
 
 class AudioActionnessHead(nn.Module):
     """
@@ -219,9 +319,8 @@ class AudioActionnessHead(nn.Module):
             else:
                 self.norm.append(nn.Identity())
 
-        self.scale = nn.ModuleList()
-        for idx in range(fpn_levels):
-            self.scale.append(Scale())
+        # one learnable scale per pyramid level
+        self.scales = nn.Parameter(torch.ones(fpn_levels))
 
         # segment regression
 
@@ -234,27 +333,32 @@ class AudioActionnessHead(nn.Module):
 
 
 
-    def forward(self, fpn_feats, fpn_masks):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_scale_keys(state_dict, prefix, self.fpn_levels)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        fpn_feats: List[torch.Tensor],
+        fpn_masks: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, List[int]]:
         assert len(fpn_feats) == len(fpn_masks)
         assert len(fpn_feats) == self.fpn_levels
 
-        # apply the classifier for each pyramid level
-        out_offsets = tuple()
-        out_conf = tuple() 
+        # apply the head to all pyramid levels at once
+        cur_out, cur_mask, keep, bounds = fuse_fpn_levels(
+            fpn_feats, fpn_masks, self.conf_head.conv.padding[0])
+        for head, norm in zip(self.head, self.norm):#cycle only for build 3 (1D convolutional + layer normal + ReLU) layers
+            cur_out, _ = head(cur_out, cur_mask) # 1D convolutional layer
+            # layer normal + ReLU, re-zero the gaps between levels
+            cur_out = self.act(norm(cur_out)) * keep
 
+        cur_conf, _ = self.conf_head(cur_out, cur_mask) # another single 1D conv layer
+        # per-level scale + activation, B x (sum T_i) x 1, and the level lengths
+        cur_conf, lens = compact_fpn_levels(cur_conf, bounds)
+        cur_conf = scale_relu(cur_conf, expand_fpn_scales(self.scales, lens))
 
-        for l, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)): #fpn_feats.shape=(2,512,T), T = [2304,1152,576,288,144,72] for all vids
-            cur_out = cur_feat
-
-
-            for idx in range(len(self.head)):#cycle only for build 3 (1D convolutional + layer normal + ReLU) layers
-                cur_out, _ = self.head[idx](cur_out, cur_mask) # 1D convolutional layer
-                cur_out = self.act(self.norm[idx](cur_out)) # layer normal + ReLU
-
-            cur_conf, _ = self.conf_head(cur_out, cur_mask) # another single 1D conv layer
-            out_conf += (F.relu(self.scale[l](cur_conf)), ) # add the activation output (shape=(1,2)) for all pyramid level
-
-        return out_conf
+        return cur_conf, lens
 
 
 
@@ -302,53 +406,61 @@ class PtTransformerRegHead(nn.Module):
             else:
                 self.norm.append(nn.Identity())
 
-        self.scale = nn.ModuleList()
-        for idx in range(fpn_levels):
-            self.scale.append(Scale())
+        # one learnable scale per pyramid level
+        self.scales = nn.Parameter(torch.ones(fpn_levels))
 
-        # segment regression
-        self.offset_head = MaskedConv1D(
-                feat_dim, 2, kernel_size,
+        # segment regression (2 channels) + offset for Gaussian conf (2 channels)
+        # in a single conv, split in forward
+        self.offset_conf_head = MaskedConv1D(
+                feat_dim, 4, kernel_size,
                 stride=1, padding=kernel_size//2
             )
-
-        # offset for Gaussian conf
-        self.conf_head = MaskedConv1D(
-                feat_dim, 2, kernel_size,
-                stride=1, padding=kernel_size//2
-            )     
         '''
         Why using mask? 
            When training with variable length input, we fixed the maximum input sequence length, padded or cropped the input sequences accordingly,
-		and added proper masking for all operations in the model. 
-		   This is equivalent to training with sliding windows.
-		'''
-
+        and added proper masking for all operations in the model. 
+           This is equivalent to training with sliding windows.
+        '''
 
-    def forward(self, fpn_feats, fpn_masks):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        merge_scale_keys(state_dict, prefix, self.fpn_levels)
+        # old checkpoints store separate offset_head / conf_head convs
+        for name in ('weight', 'bias'):
+            offset_key = prefix + 'offset_head.conv.' + name
+            conf_key = prefix + 'conf_head.conv.' + name
+            if offset_key in state_dict and conf_key in state_dict:
+                state_dict[prefix + 'offset_conf_head.conv.' + name] = torch.cat(
+                    (state_dict.pop(offset_key), state_dict.pop(conf_key)), dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(
+        self,
+        fpn_feats: List[torch.Tensor],
+        fpn_masks: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[int]]:
         assert len(fpn_feats) == len(fpn_masks)
         assert len(fpn_feats) == self.fpn_levels
 
-        # apply the classifier for each pyramid level
-        out_offsets = tuple()
-        out_conf = tuple() 
-
-        for l, (cur_feat, cur_mask) in enumerate(zip(fpn_feats, fpn_masks)): #fpn_feats.shape=(2,512,T), T = [2304,1152,576,288,144,72] for all vids
-            cur_out = cur_feat
-
-            for idx in range(len(self.head)):#cycle only for build 3 (1D convolutional + layer normal + ReLU) layers
-                cur_out, _ = self.head[idx](cur_out, cur_mask) # 1D convolutional layer
-                cur_out = self.act(self.norm[idx](cur_out)) # layer normal + ReLU
+        # apply the head to all pyramid levels at once
+        cur_out, cur_mask, keep, bounds = fuse_fpn_levels(
+            fpn_feats, fpn_masks, self.offset_conf_head.conv.padding[0])
+        for head, norm in zip(self.head, self.norm):#cycle only for build 3 (1D convolutional + layer normal + ReLU) layers
+            cur_out, _ = head(cur_out, cur_mask) # 1D convolutional layer
+            # layer normal + ReLU, re-zero the gaps between levels
+            cur_out = self.act(norm(cur_out)) * keep
 
-            ##########################################################################################
-            cur_offsets, _ = self.offset_head(cur_out, cur_mask) # another single 1D conv layer, out shape = [2, 2, T]
-            out_offsets += (F.relu(self.scale[l](cur_offsets)), ) # add the activation output (shape=(1,2)) for all pyramid level
+        ##########################################################################################
+        cur_oc, _ = self.offset_conf_head(cur_out, cur_mask) # another single 1D conv layer, out shape = [2, 4, T]
+        cur_offsets, cur_conf = cur_oc.split(2, dim=1)
+        cur_offsets, lens = compact_fpn_levels(cur_offsets, bounds)
+        cur_conf, _ = compact_fpn_levels(cur_conf, bounds)
+        # per-level scale + activation, shape = [2, sum T_i, 2], and the level lengths
+        scales = expand_fpn_scales(self.scales, lens)
+        out_offsets = scale_relu(cur_offsets, scales)
+        out_conf = scale_relu(cur_conf, scales)
+        ###########################################################################################
 
-            cur_conf, _ = self.conf_head(cur_out, cur_mask) # another single 1D conv layer
-            out_conf += (F.relu(self.scale[l](cur_conf)), ) # add the activation output (shape=(1,2)) for all pyramid level
-            ###########################################################################################
-
-        return out_offsets,out_conf
+        return out_offsets, out_conf, lens
 
 
 
@@ -506,21 +618,18 @@ class CrossAttention(nn.Module):
             query = query.float()
             key = key.float()
 
-        attention_scores = torch.baddbmm(
-            torch.empty(query.shape[0], query.shape[1], key.shape[1], dtype=query.dtype, device=query.device),
-            query,
-            key.transpose(-1, -2),
-            beta=0,
-            alpha=self.scale,
-        )
+        # no (ignored) output buffer as for baddbmm with beta=0
+        attention_scores = torch.matmul(query, key.transpose(-1, -2))
+        attention_scores.mul_(self.scale)
 
         if attention_mask is not None:
-            attention_scores = attention_scores + attention_mask
+            attention_scores.add_(attention_mask)
 
-        if self.upcast_softmax:
-            attention_scores = attention_scores.float()
-
-        attention_probs = attention_scores.softmax(dim=-1)
+        # upcast fused into the softmax
+        attention_probs = F.softmax(
+            attention_scores, dim=-1,
+            dtype=torch.float32 if self.upcast_softmax else None
+        )
         attention_probs = attention_probs.to(dtype)
 
         return attention_probs
@@ -536,23 +645,32 @@ class CrossAttention(nn.Module):
         return attention_mask
 
 class CrossAttnProcessor:
-    def __call__(self, attn: CrossAttention, hidden_states, encoder_hidden_states=None, attention_mask=None):
+    def __call__(self, attn: CrossAttention, hidden_states, encoder_hidden_states=None, attention_mask=None, seq_lens=None):
+        # seq_lens: hidden_states / encoder_hidden_states hold several independent
+        # sequences (e.g., the pyramid levels) concatenated along the sequence dim.
+        # The linear projections run once on all of them, while each sequence
+        # only attends to its own part of encoder_hidden_states.
 
         batch_size, sequence_length, _ = hidden_states.shape
         attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length)
 
         query = attn.to_q(hidden_states)
-        query = attn.head_to_batch_dim(query)
-
         encoder_hidden_states = encoder_hidden_states if encoder_hidden_states is not None else hidden_states
         key = attn.to_k(encoder_hidden_states)
         value = attn.to_v(encoder_hidden_states)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
+        if seq_lens is not None:
+            assert attention_mask is None
+            hidden_states = torch.cat([
+                self.attention(attn, q, k, v, None)
+                for q, k, v in zip(
+                    query.split(seq_lens, dim=1),
+                    key.split(seq_lens, dim=1),
+                    value.split(seq_lens, dim=1)
+                )
+            ], dim=1)
+        else:
+            hidden_states = self.attention(attn, query, key, value, attention_mask)
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
@@ -561,6 +679,32 @@ class CrossAttnProcessor:
 
         return hidden_states
 
+    @staticmethod
+    def attention(attn: CrossAttention, query, key, value, attention_mask):
+        batch_size = query.shape[0]
+        if _HAS_SDPA and not (attn.upcast_attention or attn.upcast_softmax):
+            # fused attention (flash / memory efficient kernels when available)
+            # B x S x (H * Dh) -> B x H x S x Dh, no copies
+            query, key, value = (
+                x.unflatten(-1, (attn.heads, -1)).transpose(1, 2) for x in (query, key, value)
+            )
+            if attention_mask is not None:
+                attention_mask = attention_mask.view(batch_size, attn.heads, -1, key.shape[2])
+            hidden_states = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=attention_mask)
+            # B x H x S x Dh -> B x S x (H * Dh)
+            hidden_states = hidden_states.transpose(1, 2).flatten(2)
+        else:
+            query = attn.head_to_batch_dim(query)
+            key = attn.head_to_batch_dim(key)
+            value = attn.head_to_batch_dim(value)
+
+            attention_probs = attn.get_attention_scores(query, key, attention_mask)
+            hidden_states = torch.bmm(attention_probs, value)
+            hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        return hidden_states
+
 
 
 
@@ -594,7 +738,9 @@ class PtTransformer(nn.Module):
         num_classes_v,           # number of action classes
         num_classes_n,
         train_cfg,             # other cfg for training
-        test_cfg               # other cfg for testing
+        test_cfg,              # other cfg for testing
+        head_share_trunk=False, # share the head conv trunk within each modality
+        audio_side_stream=False # run the audio backbone / neck on a cuda side stream
     ):
         super().__init__()
         # re-distribute params to backbone / neck / head
@@ -621,6 +767,21 @@ class PtTransformer(nn.Module):
             if max_div_factor < stride:
                 max_div_factor = stride
         self.max_div_factor = max_div_factor
+        # length of each pyramid level for a max_seq_len input (training)
+        self.fpn_level_lens = [max_seq_len // s for s in self.fpn_strides]
+        # anchor [x, x + 1) within its level / stride of all points (boundary labels),
+        # F T x 1 columns that broadcast against the gts
+        fpn_anchor_x = torch.cat(
+            [torch.arange(l, dtype=torch.float32) for l in self.fpn_level_lens])[:, None]
+        self.register_buffer('fpn_anchor_x', fpn_anchor_x, persistent=False)
+        self.register_buffer('fpn_anchor_x_end', fpn_anchor_x + 1, persistent=False)
+        self.register_buffer(
+            'fpn_anchor_stride',
+            torch.repeat_interleave(
+                torch.as_tensor(self.fpn_strides, dtype=torch.float32),
+                torch.as_tensor(self.fpn_level_lens))[:, None],
+            persistent=False
+        )
 
         # training time config
         self.train_center_sample = train_cfg['center_sample']
@@ -631,19 +792,24 @@ class PtTransformer(nn.Module):
         self.train_dropout = train_cfg['dropout']
         self.train_droppath = train_cfg['droppath']
         self.train_label_smoothing = train_cfg['label_smoothing']
+        self.train_use_checkpoint = train_cfg['use_checkpoint']
 
         # test time config
         self.test_pre_nms_thresh = test_cfg['pre_nms_thresh']
+        # the threshold applies to both the verb and the noun score, i.e., to
+        # their product (squared once here, not per video)
+        self.test_pre_nms_thresh_sq = float(self.test_pre_nms_thresh) ** 2
         self.test_pre_nms_topk = test_cfg['pre_nms_topk']
         self.test_iou_threshold = test_cfg['iou_threshold']
         self.test_min_score = test_cfg['min_score']
         self.test_max_seg_num = test_cfg['max_seg_num']
         self.test_nms_method = test_cfg['nms_method']
         assert self.test_nms_method in ['soft', 'hard', 'none']
-        self.test_duration_thresh = test_cfg['duration_thresh']
+        self.test_duration_thresh = float(test_cfg['duration_thresh'])
         self.test_multiclass_nms = test_cfg['multiclass_nms']
         self.test_nms_sigma = test_cfg['nms_sigma']
         self.test_voting_thresh = test_cfg['voting_thresh']
+        self.test_score_dtype = torch.bfloat16 if test_cfg['bf16_scores'] else torch.float32
 
         # we will need a better way to dispatch the params to backbones / necks
         # backbone network: conv + transformer
@@ -665,7 +831,8 @@ class PtTransformer(nn.Module):
                     'proj_pdrop' : self.train_dropout,
                     'path_pdrop' : self.train_droppath,
                     'use_abs_pe' : use_abs_pe,
-                    'use_rel_pe' : use_rel_pe
+                    'use_rel_pe' : use_rel_pe,
+                    'use_checkpoint' : self.train_use_checkpoint
                 }
             )
 
@@ -685,7 +852,8 @@ class PtTransformer(nn.Module):
                     'proj_pdrop' : self.train_dropout,
                     'path_pdrop' : self.train_droppath,
                     'use_abs_pe' : use_abs_pe,
-                    'use_rel_pe' : use_rel_pe
+                    'use_rel_pe' : use_rel_pe,
+                    'use_checkpoint' : self.train_use_checkpoint
                 }
             )
         else:
@@ -735,16 +903,36 @@ class PtTransformer(nn.Module):
         )
 
 
-        self.cls_head_verb = PtTransformerClsHeadV(
-            fpn_dim, head_dim, self.num_classes_verb,
+        # shared trunks: the cls / reg heads of a modality then only keep
+        # their output conv, and the trunk runs once instead of once per head
+        self.head_share_trunk = head_share_trunk
+        if self.head_share_trunk:
+            self.trunk_visual = PtTransformerHeadTrunk(
+                fpn_dim, head_dim,
+                kernel_size=head_kernel_size,
+                with_ln=head_with_ln
+            )
+            self.trunk_audio = PtTransformerHeadTrunk(
+                fpn_dim, head_dim,
+                kernel_size=head_kernel_size,
+                with_ln=head_with_ln
+            )
+            head_input_dim, head_num_layers = head_dim, 1
+        else:
+            head_input_dim, head_num_layers = fpn_dim, 3
+
+        self.cls_head_verb = PtTransformerClsHead(
+            head_input_dim, head_dim, self.num_classes_verb,
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             prior_prob=self.train_cls_prior_prob,
             with_ln=head_with_ln,
             empty_cls=train_cfg['head_empty_cls_v']
         )
 
-        self.cls_head_noun = PtTransformerClsHeadN(
-            fpn_dim, head_dim, self.num_classes_noun,
+        self.cls_head_noun = PtTransformerClsHead(
+            head_input_dim, head_dim, self.num_classes_noun,
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             prior_prob=self.train_cls_prior_prob,
             with_ln=head_with_ln,
@@ -752,7 +940,8 @@ class PtTransformer(nn.Module):
         )
 
         self.reg_head = PtTransformerRegHead(
-            fpn_dim, head_dim, len(self.fpn_strides),
+            head_input_dim, head_dim, len(self.fpn_strides),
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             with_ln=head_with_ln
         )
@@ -760,16 +949,18 @@ class PtTransformer(nn.Module):
 
 
         ########################################################### audio ########################
-        self.cls_head_verb_audio = PtTransformerClsHeadV(
-            fpn_dim, head_dim, self.num_classes_verb,
+        self.cls_head_verb_audio = PtTransformerClsHead(
+            head_input_dim, head_dim, self.num_classes_verb,
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             prior_prob=self.train_cls_prior_prob,
             with_ln=head_with_ln,
             empty_cls=train_cfg['head_empty_cls_v']
         )
 
-        self.cls_head_noun_audio = PtTransformerClsHeadN(
-            fpn_dim, head_dim, self.num_classes_noun,
+        self.cls_head_noun_audio = PtTransformerClsHead(
+            head_input_dim, head_dim, self.num_classes_noun,
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             prior_prob=self.train_cls_prior_prob,
             with_ln=head_with_ln,
@@ -777,7 +968,8 @@ class PtTransformer(nn.Module):
         )
 
         self.reg_head_audio = PtTransformerRegHead(
-            fpn_dim, head_dim, len(self.fpn_strides),
+            head_input_dim, head_dim, len(self.fpn_strides),
+            num_layers=head_num_layers,
             kernel_size=head_kernel_size,
             with_ln=head_with_ln
         )
@@ -787,9 +979,31 @@ class PtTransformer(nn.Module):
             kernel_size=head_kernel_size,
             with_ln=head_with_ln
         )
+        # device of the audio tower if it is not on the main device
+        # (see place_audio_tower)
+        self.audio_device = None
+        # if to overlap the audio backbone / neck with the visual ones on a
+        # side stream (cuda), the streams are created once per device
+        self.audio_side_stream = audio_side_stream
+        self.audio_streams = {}
+        # zero-size buffer that follows the model across devices (see device)
+        self.register_buffer('_device_probe', torch.empty(0), persistent=False)
+        # padded inputs / masks reused across training steps (see batch_feats)
+        self.input_buffers = {}
+        # level index of the concatenated points in inference (see fpn_level_index)
+        self.level_index_cache = None
+        # if the inference returns the host part of its postprocessing as a
+        # callable instead of running it (see valid_one_epoch)
+        self.defer_postprocessing = False
+
         # maintain an EMA of #foreground to stabilize the loss normalizer
         # useful for small mini-batch training
-        self.loss_normalizer = train_cfg['init_loss_norm']
+        # (kept on the device as a tensor -> no host sync per step)
+        self.register_buffer(
+            'loss_normalizer',
+            torch.tensor(float(train_cfg['init_loss_norm'])),
+            persistent=False
+        )
         self.loss_normalizer_momentum = 0.9
 
         self.cross_attn = CrossAttention(
@@ -808,134 +1022,284 @@ class PtTransformer(nn.Module):
 
 
 
+    def script_heads(self):
+        """
+        Replace the heads by scripted and frozen copies (for inference only)
+        Scripting removes the python overhead of the per-layer loops, and
+        freezing folds the weights (e.g., the prior bias of the cls heads)
+        into the graph. Call this after loading the weights: the frozen heads
+        no longer have parameters (nor state_dict entries).
+        """
+        assert not self.training, "Scripted heads are for inference only"
+        head_names = [
+            'cls_head_verb', 'cls_head_noun', 'reg_head',
+            'cls_head_verb_audio', 'cls_head_noun_audio', 'actionness_head_audio'
+        ]
+        if self.head_share_trunk:
+            head_names += ['trunk_visual', 'trunk_audio']
+        for name in head_names:
+            setattr(self, name, torch.jit.freeze(torch.jit.script(getattr(self, name))))
+
+    def quantize_heads(self):
+        """
+        Quantize the convs of the heads to int8 (dynamic quantization, for
+        cpu inference only). The backbones / necks remain in fp32.
+        Call this after loading the weights (and before script_heads).
+        See QuantConv1d in blocks.py
+        """
+        assert not self.training, "Quantized heads are for inference only"
+        head_names = [
+            'cls_head_verb', 'cls_head_noun', 'reg_head',
+            'cls_head_verb_audio', 'cls_head_noun_audio', 'actionness_head_audio'
+        ]
+        if self.head_share_trunk:
+            head_names += ['trunk_visual', 'trunk_audio']
+        for name in head_names:
+            for module in getattr(self, name).modules():
+                if isinstance(module, MaskedConv1D):
+                    module.quantize_dynamic()
+
+    def compile_modules(self, mode='reduce-overhead'):
+        """
+        Compile the backbones / necks / cross attention / heads in place with
+        torch.compile (torch >= 2.2), fusing the many small kernels of the
+        forward pass (mode='reduce-overhead' also replays them as cuda graphs).
+        The state_dict keys remain unchanged. Call this after the ModelEma
+        copy: a compiled module can not be deep copied nor replicated by
+        nn.DataParallel (i.e., single gpu only).
+        """
+        if not hasattr(nn.Module, 'compile'):
+            print("torch.compile requires torch >= 2.2, skipped.")
+            return self
+        modules = [
+            'backbone_visual', 'backbone_audio', 'neck_visual', 'neck_audio', 'cross_attn',
+            'cls_head_verb', 'cls_head_noun', 'reg_head',
+            'cls_head_verb_audio', 'cls_head_noun_audio', 'actionness_head_audio'
+        ]
+        if self.head_share_trunk:
+            modules += ['trunk_visual', 'trunk_audio']
+        for name in modules:
+            getattr(self, name).compile(mode=mode)
+        return self
+
+    def place_audio_tower(self, device):
+        """
+        Model parallelism across modalities: move the audio backbone / neck /
+        cls heads to another device, such that the audio tower runs
+        concurrently with the visual one. Only the audio fpn feats / masks
+        and logits are copied back to the main device (fusion, losses and
+        inference). Note that nn.DataParallel requires all params on its
+        first device, i.e., the model can not be wrapped by it.
+        """
+        self.audio_device = torch.device(device)
+        audio_modules = [
+            self.backbone_audio, self.neck_audio,
+            self.cls_head_verb_audio, self.cls_head_noun_audio
+        ]
+        if self.head_share_trunk:
+            audio_modules.append(self.trunk_audio)
+        for module in audio_modules:
+            module.to(self.audio_device)
+        return self
+
     @property
     def device(self):
-        # a hacky way to get the device type
-        # will throw an error if parameters are on different devices
-        return list(set(p.device for p in self.parameters()))[0]
+        # the main device, i.e., the one of the visual tower
+        # (read from a buffer: no traversal of the params per call)
+        return self._device_probe.device
+
+    def get_audio_stream(self, device):
+        # side stream of the audio branch on this device (created on first use)
+        stream = self.audio_streams.get(device)
+        if stream is None:
+            stream = torch.cuda.Stream(device=device)
+            self.audio_streams[device] = stream
+        return stream
+
+    def forward_audio_heads(self, fpn_feats_audio, fpn_masks_audio):
+        # cls heads of the audio tower
+        if self.head_share_trunk:
+            head_feats_audio = self.trunk_audio(fpn_feats_audio, fpn_masks_audio)
+        else:
+            head_feats_audio = fpn_feats_audio
+        out_cls_logits_verb_audio, _ = self.cls_head_verb_audio(head_feats_audio, fpn_masks_audio)
+        out_cls_logits_noun_audio, _ = self.cls_head_noun_audio(head_feats_audio, fpn_masks_audio)
+        #out_offsets_audio , out_conf_audio  = self.reg_head_audio (head_feats_audio, fpn_masks_audio)
+        return out_cls_logits_verb_audio, out_cls_logits_noun_audio
 
     def forward(self, video_list, args, cross_attention_kwargs=None):
+        # return loss during training, the decoded actions otherwise
+        if self.training:
+            return self.forward_train(video_list, args, cross_attention_kwargs)
+        return self.forward_eval(video_list, args, cross_attention_kwargs)
+
+    def forward_network(self, video_list, cross_attention_kwargs=None):
+        """
+            Shared by forward_train / forward_eval: batch the inputs and run the
+            network (no train / eval dependent control flow). Return the points,
+            the visual / audio masks (F (List) [B, T_i]) and the head outputs of
+            all levels ([B, sum T_i, C])
+        """
         # batch the video list into feats (B, C, T) and masks (B, 1, T)
         batched_inputs_visual, batched_masks_visual = self.preprocessing_visual(video_list)
-        batched_inputs_audio, batched_masks_audio = self.preprocessing_audio(video_list)
-
-        if self.training:
-            vid_idx = []
-            vid_idx.append(video_list[0]['video_id'])
-            vid_idx.append(video_list[1]['video_id'])
+        batched_inputs_audio, batched_masks_audio = self.preprocessing_audio(
+            video_list, masks_visual=batched_masks_visual)
 
         # forward the network (backbone -> neck -> heads)
+        audio_stream = None
+        if self.audio_device is not None:
+            # the audio tower is on its own device and is launched first,
+            # such that it runs concurrently with the visual one
+            feats_audio, masks_audio = self.backbone_audio(batched_inputs_audio, batched_masks_audio)
+            fpn_feats_audio, fpn_masks_audio = self.neck_audio(feats_audio, masks_audio)
+            out_cls_logits_verb_audio, out_cls_logits_noun_audio = self.forward_audio_heads(
+                fpn_feats_audio, fpn_masks_audio)
+        elif self.audio_side_stream and batched_inputs_audio.is_cuda:
+            # the audio branch runs on a side stream and overlaps with the visual one
+            audio_stream = self.get_audio_stream(batched_inputs_audio.device)
+            audio_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(audio_stream):
+                feats_audio, masks_audio = self.backbone_audio(batched_inputs_audio, batched_masks_audio)
+                fpn_feats_audio, fpn_masks_audio = self.neck_audio(feats_audio, masks_audio)
+
         feats_visual, masks_visual = self.backbone_visual(batched_inputs_visual, batched_masks_visual)
         fpn_feats_visual, fpn_masks_visual = self.neck_visual(feats_visual, masks_visual)
 
-        #feats_audio, masks_audio = self.backbone_visual(batched_inputs_audio, batched_masks_audio)
-        feats_audio, masks_audio = self.backbone_audio(batched_inputs_audio, batched_masks_audio)
-        fpn_feats_audio, fpn_masks_audio = self.neck_audio(feats_audio, masks_audio)
-
-        visual_audio_fusion_feat = []
-        for level, level_feat in enumerate(fpn_feats_visual):
-            
-            visual_audio = []
-
-            level_feat = torch.transpose(level_feat,1,2)
-            fpn_feats_audio_lel = torch.transpose(fpn_feats_audio[level],1,2)
-            cross_attention_kwargs = cross_attention_kwargs if cross_attention_kwargs is not None else {}
-            attn_output = self.cross_attn(
-                    level_feat,
-                    encoder_hidden_states=fpn_feats_audio_lel,
-                    attention_mask=None,
-                    **cross_attention_kwargs,
-                )
-
-            out = torch.transpose(attn_output,1,2)
-
-            visual_audio_fusion_feat.append(out)
+        if audio_stream is not None:
+            # join before the inputs go out of scope (no record_stream needed)
+            torch.cuda.current_stream().wait_stream(audio_stream)
+        elif self.audio_device is None:
+            #feats_audio, masks_audio = self.backbone_visual(batched_inputs_audio, batched_masks_audio)
+            feats_audio, masks_audio = self.backbone_audio(batched_inputs_audio, batched_masks_audio)
+            fpn_feats_audio, fpn_masks_audio = self.neck_audio(feats_audio, masks_audio)
+
+        if self.audio_device is not None:
+            # copy the outputs of the audio tower to the main device
+            device = self.device
+            fpn_feats_audio = [x.to(device, non_blocking=True) for x in fpn_feats_audio]
+            fpn_masks_audio = [x.to(device, non_blocking=True) for x in fpn_masks_audio]
+            out_cls_logits_verb_audio = out_cls_logits_verb_audio.to(device, non_blocking=True)
+            out_cls_logits_noun_audio = out_cls_logits_noun_audio.to(device, non_blocking=True)
+
+        # cross attention between the visual / audio feats of the same pyramid level,
+        # all levels in one call: B x C x T_l -> B x (sum T_l) x C
+        level_lens = [x.shape[-1] for x in fpn_feats_visual]
+        cross_attention_kwargs = cross_attention_kwargs if cross_attention_kwargs is not None else {}
+        attn_output = self.cross_attn(
+                torch.cat([x.transpose(1, 2) for x in fpn_feats_visual], dim=1),
+                encoder_hidden_states=torch.cat([x.transpose(1, 2) for x in fpn_feats_audio], dim=1),
+                attention_mask=None,
+                seq_lens=level_lens,
+                **cross_attention_kwargs,
+            )
+        # B x (sum T_l) x C -> B x C x T_l views (the actionness head concatenates the levels)
+        visual_audio_fusion_feat = list(attn_output.transpose(1, 2).split(level_lens, dim=2))
 
         points = self.point_generator(fpn_feats_visual)
 
 
-        ################################# visual ####################################3
-        out_cls_logits_verb_visual = self.cls_head_verb(fpn_feats_visual, fpn_masks_visual)
-        out_cls_logits_noun_visual = self.cls_head_noun(fpn_feats_visual, fpn_masks_visual)
-        out_offsets_visual, out_conf_visual = self.reg_head(fpn_feats_visual, fpn_masks_visual)
-
-        out_cls_logits_verb_visual = [x.permute(0, 2, 1) for x in out_cls_logits_verb_visual]
-        out_cls_logits_noun_visual = [x.permute(0, 2, 1) for x in out_cls_logits_noun_visual]
-
-        out_offsets_visual = [x.permute(0, 2, 1) for x in out_offsets_visual]
+        if self.head_share_trunk:
+            head_feats_visual = self.trunk_visual(fpn_feats_visual, fpn_masks_visual)
+        else:
+            head_feats_visual = fpn_feats_visual
 
-        out_conf_visual = [x.permute(0, 2, 1) for x in out_conf_visual]
+        ################################# visual ####################################3
+        out_cls_logits_verb_visual, _ = self.cls_head_verb(head_feats_visual, fpn_masks_visual)
+        out_cls_logits_noun_visual, _ = self.cls_head_noun(head_feats_visual, fpn_masks_visual)
+        out_offsets_visual, out_conf_visual, _ = self.reg_head(head_feats_visual, fpn_masks_visual)
 
+        # the heads output B x (sum T_i) x C, the masks B x T_i
         fpn_masks_visual = [x.squeeze(1) for x in fpn_masks_visual]
 
         ################################# audio ####################################3
-        out_cls_logits_verb_audio = self.cls_head_verb_audio (fpn_feats_audio, fpn_masks_audio)
-        out_cls_logits_noun_audio  = self.cls_head_noun_audio (fpn_feats_audio, fpn_masks_audio)
-        #out_offsets_audio , out_conf_audio  = self.reg_head_audio (fpn_feats_audio, fpn_masks_audio)
+        if self.audio_device is None:
+            out_cls_logits_verb_audio, out_cls_logits_noun_audio = self.forward_audio_heads(
+                fpn_feats_audio, fpn_masks_audio)
 
         ################################ audio + visual #################################
-        out_cls_logits_actionness  = self.actionness_head_audio(visual_audio_fusion_feat, fpn_masks_audio)
+        out_cls_logits_actionness, _ = self.actionness_head_audio(visual_audio_fusion_feat, fpn_masks_audio)
 
 
 
         ######################################################################
-        out_cls_logits_actionness= [x.permute(0, 2, 1) for x in out_cls_logits_actionness]
-        out_cls_logits_verb_audio  = [x.permute(0, 2, 1) for x in out_cls_logits_verb_audio]
-        out_cls_logits_noun_audio  = [x.permute(0, 2, 1) for x in out_cls_logits_noun_audio]
         # out_offsets_audio = [x.permute(0, 2, 1) for x in out_offsets_audio]
         # out_conf_audio = [x.permute(0, 2, 1) for x in out_conf_audio]
         fpn_masks_audio = [x.squeeze(1) for x in fpn_masks_audio]
 
+        return (
+            points,
+            fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
+            fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_cls_logits_actionness
+        )
 
-        # return loss during training
-        if self.training:
-            # generate segment/lable List[N x 2] / List[N] with length = B
-            assert video_list[0]['segments'] is not None, "GT action labels does not exist"
-            assert video_list[0]['labels_v'] is not None, "GT action labels does not exist"
-            assert video_list[0]['labels_n'] is not None, "GT action labels does not exist"
-            gt_segments = [x['segments'].to(self.device) for x in video_list]
-            gt_labels_v = [x['labels_v'].to(self.device) for x in video_list]
-            gt_labels_n = [x['labels_n'].to(self.device) for x in video_list]
-
-            gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action = self.label_points(args,
-                points, gt_segments, gt_labels_v, gt_labels_n)
-
-
-            losses_visaul = self.losses(
-                args,
-                vid_idx, 
-                fpn_masks_visual,
-                out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
-                gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action, out_cls_logits_actionness, is_audio = False
-            )
+    def forward_train(self, video_list, args, cross_attention_kwargs=None):
+        vid_idx = [x['video_id'] for x in video_list]
 
-            losses_audio = self.losses(
-                args,
-                vid_idx, 
-                fpn_masks_audio,
-                out_cls_logits_verb_audio, out_cls_logits_noun_audio, None, None,
-                gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action, None, is_audio = True
+        (points,
+         fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
+         fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_cls_logits_actionness
+        ) = self.forward_network(video_list, cross_attention_kwargs)
+
+        # the labels / losses are computed in fp32 under autocast (see losses)
+        with torch.autocast(self.device.type, enabled=False):
+            return self.compute_losses(
+                video_list, args, vid_idx, points,
+                fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
+                fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_cls_logits_actionness
             )
 
-            losses = {}
-            losses['cls_v'] = losses_visaul['cls_loss_v'] + args.loss_a_weight*losses_audio['cls_loss_v']
-            losses['cls_n'] = losses_visaul['cls_loss_n'] + args.loss_a_weight*losses_audio['cls_loss_n']
-            losses['reg_visual'] = losses_visaul['reg_loss']
-            losses['action'] = losses_visaul['act_loss']
+    def compute_losses(
+        self, video_list, args, vid_idx, points,
+        fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
+        fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_cls_logits_actionness
+    ):
+        # generate segment/lable List[N x 2] / List[N] with length = B
+        assert video_list[0]['segments'] is not None, "GT action labels does not exist"
+        assert video_list[0]['labels_v'] is not None, "GT action labels does not exist"
+        assert video_list[0]['labels_n'] is not None, "GT action labels does not exist"
+        device = self.device
+        gt_segments = [x['segments'].to(device, non_blocking=True) for x in video_list]
+        gt_labels_v = [x['labels_v'].to(device, non_blocking=True) for x in video_list]
+        gt_labels_n = [x['labels_n'].to(device, non_blocking=True) for x in video_list]
+
+        gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action = self.label_points(args,
+            points, gt_segments, gt_labels_v, gt_labels_n)
+
+
+        losses_visaul = self.losses(
+            args,
+            vid_idx, 
+            fpn_masks_visual,
+            out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual,
+            gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action, out_cls_logits_actionness, is_audio = False
+        )
 
-            losses['final_loss'] = losses['cls_v'] + losses['cls_n'] + losses['reg_visual'] + args.loss_act_weight*losses['action']
+        losses_audio = self.losses(
+            args,
+            vid_idx, 
+            fpn_masks_audio,
+            out_cls_logits_verb_audio, out_cls_logits_noun_audio, None, None,
+            gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action, None, is_audio = True
+        )
 
-            return losses
+        losses = {}
+        losses['cls_v'] = losses_visaul['cls_loss_v'] + args.loss_a_weight*losses_audio['cls_loss_v']
+        losses['cls_n'] = losses_visaul['cls_loss_n'] + args.loss_a_weight*losses_audio['cls_loss_n']
+        losses['reg_visual'] = losses_visaul['reg_loss']
+        losses['action'] = losses_visaul['act_loss']
 
-        else:
-            # decode the actions (sigmoid / stride, etc)
-            results = self.inference(
-                args,
-                video_list, points, 
-                fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual, 
-                fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_cls_logits_actionness
-            )
-            return results
+        losses['final_loss'] = losses['cls_v'] + losses['cls_n'] + losses['reg_visual'] + args.loss_act_weight*losses['action']
+
+        return losses
+
+    def forward_eval(self, video_list, args, cross_attention_kwargs=None):
+        points, *outputs = self.forward_network(video_list, cross_attention_kwargs)
+        # decode the actions (sigmoid / stride, etc) in fp32 under autocast
+        # (the head outputs are tensors, the masks lists of bool tensors)
+        outputs = [out.float() if torch.is_tensor(out) else out for out in outputs]
+        with torch.autocast(self.device.type, enabled=False):
+            results = self.inference(args, video_list, points, *outputs)
+        return results
 
     @torch.no_grad()
     def preprocessing_visual(self, video_list, padding_val=0.0):
@@ -943,60 +1307,42 @@ class PtTransformer(nn.Module):
             Generate batched features and masks from a list of dict items
         """
         feats = [x['feats_v'] for x in video_list]
-        feats_lens = torch.as_tensor([feat.shape[-1] for feat in feats])
-        max_len = feats_lens.max(0).values.item()
-
-        if self.training:
-            assert max_len <= self.max_seq_len, "Input length must be smaller than max_seq_len during training"
-            # set max_len to self.max_seq_len
-            max_len = self.max_seq_len
-            # batch input shape B, C, T
-            batch_shape = [len(feats), feats[0].shape[0], max_len]
-            batched_inputs = feats[0].new_full(batch_shape, padding_val)
-            for feat, pad_feat in zip(feats, batched_inputs):
-                pad_feat[..., :feat.shape[-1]].copy_(feat)
-        else:
-            assert len(video_list) == 1, "Only support batch_size = 1 during inference"
-            # input length < self.max_seq_len, pad to max_seq_len
-            if max_len <= self.max_seq_len:
-                max_len = self.max_seq_len
-            else:
-                # pad the input to the next divisible size
-                stride = self.max_div_factor
-                max_len = (max_len + (stride - 1)) // stride * stride
-            padding_size = [0, max_len - feats_lens[0]]
-            batched_inputs = F.pad(
-                feats[0], padding_size, value=padding_val).unsqueeze(0)
-
-        # generate the mask
-        batched_masks = torch.arange(max_len)[None, :] < feats_lens[:, None]
-
-        # push to device
-        batched_inputs = batched_inputs.to(self.device)
-        batched_masks = batched_masks.unsqueeze(1).to(self.device)
-
-        return batched_inputs, batched_masks
+        return self.batch_feats(feats, self.device, 'visual', padding_val)
 
     @torch.no_grad()
-    def preprocessing_audio(self, video_list, padding_val=0.0):
+    def preprocessing_audio(self, video_list, padding_val=0.0, masks_visual=None):
         """
             Generate batched features and masks from a list of dict items
+            The mask of the visual feats is reused if they have the same lengths
         """
         feats = [x['feats_a'] for x in video_list]
-        feats_lens = torch.as_tensor([feat.shape[-1] for feat in feats])
-        max_len = feats_lens.max(0).values.item()
+        # the device of the audio tower
+        device = self.device if self.audio_device is None else self.audio_device
+        if masks_visual is not None and any(
+            x['feats_a'].shape[-1] != x['feats_v'].shape[-1] for x in video_list
+        ):
+            masks_visual = None
+        return self.batch_feats(feats, device, 'audio', padding_val, masks=masks_visual)
+
+    @torch.no_grad()
+    def batch_feats(self, feats, device, buffer_key, padding_val=0.0, masks=None):
+        """
+            Pad a list of C x T_i features into a B x C x T batch (and B x 1 x T mask)
+            directly on the device: only the valid part of each feature is copied
+            (and cast to fp32). In training, the batch is written into buffers
+            reused across steps (T = max_seq_len is fixed).
+            masks: optional B x 1 x T mask of features with the same lengths
+            (e.g., the visual mask for the audio feats), returned as is
+        """
+        feats_lens = [feat.shape[-1] for feat in feats]
+        max_len = max(feats_lens)
 
         if self.training:
             assert max_len <= self.max_seq_len, "Input length must be smaller than max_seq_len during training"
             # set max_len to self.max_seq_len
             max_len = self.max_seq_len
-            # batch input shape B, C, T
-            batch_shape = [len(feats), feats[0].shape[0], max_len]
-            batched_inputs = feats[0].new_full(batch_shape, padding_val)
-            for feat, pad_feat in zip(feats, batched_inputs):
-                pad_feat[..., :feat.shape[-1]].copy_(feat)
         else:
-            assert len(video_list) == 1, "Only support batch_size = 1 during inference"
+            assert len(feats) == 1, "Only support batch_size = 1 during inference"
             # input length < self.max_seq_len, pad to max_seq_len
             if max_len <= self.max_seq_len:
                 max_len = self.max_seq_len
@@ -1004,36 +1350,63 @@ class PtTransformer(nn.Module):
                 # pad the input to the next divisible size
                 stride = self.max_div_factor
                 max_len = (max_len + (stride - 1)) // stride * stride
-            padding_size = [0, max_len - feats_lens[0]]
-            batched_inputs = F.pad(
-                feats[0], padding_size, value=padding_val).unsqueeze(0)
-
-        # generate the mask
-        batched_masks = torch.arange(max_len)[None, :] < feats_lens[:, None]
 
-        # push to device
-        batched_inputs = batched_inputs.to(self.device)
-        batched_masks = batched_masks.unsqueeze(1).to(self.device)
+        # batch input shape B, C, T
+        batch_shape = (len(feats), feats[0].shape[0], max_len)
+        # keyed by device: the nn.DataParallel replicas share this dict
+        buffer_key = (buffer_key, str(device))
+        buffers = self.input_buffers.get(buffer_key)
+        if self.training and buffers is not None and buffers[0].shape == batch_shape:
+            batched_inputs, batched_masks = buffers
+        else:
+            batched_inputs = torch.empty(batch_shape, dtype=torch.float32, device=device)
+            batched_masks = torch.empty((len(feats), 1, max_len), dtype=torch.bool, device=device)
+            if self.training:
+                self.input_buffers[buffer_key] = (batched_inputs, batched_masks)
+        share_masks = (
+            masks is not None and masks.device == batched_masks.device
+            and masks.shape == batched_masks.shape
+        )
+        if share_masks:
+            batched_masks = masks
+
+        # copy the feats (may be fp16 on the host) and pad, generate the mask
+        # the loader pins the feats (pin_memory), pin them here otherwise so
+        # that the host to device copies do not block
+        if device.type == 'cuda':
+            feats = [feat.pin_memory() if (feat.device.type == 'cpu' and not feat.is_pinned()) else feat
+                     for feat in feats]
+        for feat, feat_len, pad_feat, pad_mask in zip(feats, feats_lens, batched_inputs, batched_masks):
+            pad_feat[:, :feat_len].copy_(feat, non_blocking=True)
+            pad_feat[:, feat_len:].fill_(padding_val)
+            if not share_masks:
+                pad_mask[:, :feat_len].fill_(True)
+                pad_mask[:, feat_len:].fill_(False)
 
         return batched_inputs, batched_masks
 
 
-    def ioa_with_anchors(self,anchors_min,anchors_max,box_min,box_max):
+    @staticmethod
+    def ioa_with_anchors(anchors_min, anchors_max, box_min, box_max):
         """Compute intersection between score a box and the anchors.
+        Broadcasts: anchors (N x 1) and boxes (M, ) give all N x M pairs at once
         """
         len_anchors=anchors_max-anchors_min
-        int_xmin = np.maximum(anchors_min, box_min)
-        int_xmax = np.minimum(anchors_max, box_max)
-        inter_len = np.maximum(int_xmax - int_xmin, 0.)
-        scores = np.divide(inter_len, len_anchors)
+        int_xmin = torch.maximum(anchors_min, box_min)
+        int_xmax = torch.minimum(anchors_max, box_max)
+        inter_len = (int_xmax - int_xmin).clamp_(min=0.)
+        scores = inter_len.div_(len_anchors)
         return scores
 
-    def iou_with_anchors(self,anchors_min, anchors_max, box_min, box_max):
-        int_xmin = np.maximum(anchors_min, box_min)
-        int_xmax = np.minimum(anchors_max, box_max)
-        inter_len = np.maximum(int_xmax - int_xmin, 0.)
+    @staticmethod
+    def iou_with_anchors(anchors_min, anchors_max, box_min, box_max):
+        """Compute the iou between the anchors and the boxes (broadcast as in ioa_with_anchors)
+        """
+        int_xmin = torch.maximum(anchors_min, box_min)
+        int_xmax = torch.minimum(anchors_max, box_max)
+        inter_len = torch.clamp(int_xmax - int_xmin, min=0.)
         union_len = (anchors_max - anchors_min) + (box_max - box_min) - inter_len
-        iou = np.divide(inter_len, union_len)
+        iou = torch.div(inter_len, union_len)
         return iou
 
     @torch.no_grad()
@@ -1041,21 +1414,30 @@ class PtTransformer(nn.Module):
         # concat points on all fpn levels List[T x 4] -> F T x 4
         # This is shared for all samples in the mini-batch
         num_levels = len(points)
-        concat_points = torch.cat(points, dim=0)
-        gt_cls_v, gt_cls_n, gt_offset, gt_start, gt_end, gt_action = [], [], [], [], [], []
+        concat_points = self.point_generator.concat(points)
+        num_pts = concat_points.shape[0]
+        num_vids = len(gt_segments)
+
+        # batched targets (B, FT (x 2)) filled in place, shared by the
+        # visual / audio losses (no per-loss torch.stack of lists)
+        gt_cls_v = gt_labels_v[0].new_empty((num_vids, num_pts))
+        gt_cls_n = gt_labels_n[0].new_empty((num_vids, num_pts))
+        gt_offset = gt_segments[0].new_empty((num_vids, num_pts, 2))
+        gt_start = gt_segments[0].new_empty((num_vids, num_pts))
+        gt_end = gt_segments[0].new_empty((num_vids, num_pts))
+        gt_action = gt_segments[0].new_empty((num_vids, num_pts))
 
         # loop over each video sample
-        for gt_segment, gt_label_v, gt_label_n in zip(gt_segments, gt_labels_v, gt_labels_n):
+        for idx, (gt_segment, gt_label_v, gt_label_n) in enumerate(zip(gt_segments, gt_labels_v, gt_labels_n)):
             cls_targets_v, cls_targets_n, reg_targets, starting_gt, ending_gt, action_gt = self.label_points_single_video(args,
                 concat_points, gt_segment, gt_label_v, gt_label_n
             )
-            # append to list (len = # images, each of size FT x C)
-            gt_cls_v.append(cls_targets_v)
-            gt_cls_n.append(cls_targets_n)
-            gt_offset.append(reg_targets)
-            gt_start.append(starting_gt)
-            gt_end.append(ending_gt)
-            gt_action.append(action_gt)
+            gt_cls_v[idx] = cls_targets_v
+            gt_cls_n[idx] = cls_targets_n
+            gt_offset[idx] = reg_targets
+            gt_start[idx] = starting_gt
+            gt_end[idx] = ending_gt
+            gt_action[idx] = action_gt
 
         return gt_cls_v, gt_cls_n, gt_offset, gt_start, gt_end, gt_action
 
@@ -1072,7 +1454,11 @@ class PtTransformer(nn.Module):
             cls_targets_v = gt_label_v.new_full((num_pts,), self.num_classes_verb)
             cls_targets_n = gt_label_n.new_full((num_pts,), self.num_classes_noun)
             reg_targets = gt_segment.new_zeros((num_pts, 2))
-            return cls_targets_v, cls_targets_n, reg_targets
+            # no boundaries, background centerness (as outside of all gts)
+            starting_gt = gt_segment.new_zeros((num_pts,))
+            ending_gt = gt_segment.new_zeros((num_pts,))
+            action_gt = gt_segment.new_full((num_pts,), 0.1)
+            return cls_targets_v, cls_targets_n, reg_targets, starting_gt, ending_gt, action_gt
 
         # compute the lengths of all segments -> F T x N
         lens = gt_segment[:, 1] - gt_segment[:, 0]
@@ -1143,66 +1529,39 @@ class PtTransformer(nn.Module):
 
 
         ##################################### boundary lable ##########################################
-        action_gt = []
-        starting_gt = []
-        ending_gt = []
-
-        gt_bbox=gt_segment.cpu().numpy()
-        #break
-        num_levels = [2304, 1152, 576, 288, 144, 72]
-        level_ratio = [1, 2, 4, 8, 16, 32] 
-        for level in range(6):
-
-            gt_xmins=gt_bbox[:,0]/level_ratio[level]
-            gt_xmaxs=gt_bbox[:,1]/level_ratio[level]
-
-            anchor_xmin=[x for x in range(num_levels[level])]
-            anchor_xmax=[x+1 for x in range(num_levels[level])]
-            
-            gt_lens=gt_xmaxs-gt_xmins
-            gt_len_small=np.maximum(1,0.1*gt_lens)
-
-            anchor_xmin_cen=anchor_xmin.copy()
-            anchor_xmax_cen=anchor_xmax.copy()
-
-            for i,x in enumerate(range(num_levels[level])):
-                for gt_i in range(len(gt_xmins)):
-                    if x in range(int(gt_xmins[gt_i]),int(gt_xmaxs[gt_i]),1):
-                        cen_gap = np.maximum(1, gt_xmaxs[gt_i] - gt_xmins[gt_i])
-                        anchor_xmin_cen[i] = np.maximum(1, x - cen_gap/2)
-                        anchor_xmax_cen[i] = x + cen_gap/2
-
-
-            gt_start_bboxs=np.stack((gt_xmins-gt_len_small/2,gt_xmins+gt_len_small/2),axis=1)
-            gt_end_bboxs=np.stack((gt_xmaxs-gt_len_small/2,gt_xmaxs+gt_len_small/2),axis=1)
-
-            ##################################### Gaussian centerness label ############################################
-            gt_center = (gt_xmins+gt_xmaxs)/2
+        # all anchors of all pyramid levels (F T) x gts (N) at once, each
+        # anchor [x, x + 1) in the feature grid of its level
+        # (precomputed F T x 1 buffers on the device of the model, no host round trip)
+        anchor_xmin = self.fpn_anchor_x.to(gt_segment.dtype)
+        anchor_xmax = self.fpn_anchor_x_end.to(gt_segment.dtype)
+        level_ratio = self.fpn_anchor_stride.to(gt_segment.dtype)
 
-            match_score_action=[0.1]*len(anchor_xmin)            
-            for ii in range(len(anchor_xmin)):
-                for gt_id in range(len(gt_xmins)):
-                    if ii >= gt_xmins[gt_id] and ii <= gt_xmaxs[gt_id]:
-                        distance_cen =  torch.Tensor([abs(ii - gt_center[gt_id])])
-                        centerness_value = torch.exp(torch.div(-torch.square(distance_cen),2*args.cen_gau_sigma*args.cen_gau_sigma))
-                        match_score_action[ii] = centerness_value
-            ###################################################################################################
-
-            match_score_start=[]
-            for jdx in range(len(anchor_xmin)):
-                match_score_start.append(np.max(self.ioa_with_anchors(anchor_xmin[jdx],anchor_xmax[jdx],gt_start_bboxs[:,0],gt_start_bboxs[:,1])))
-            match_score_end=[]
-            for jdx in range(len(anchor_xmin)):
-                match_score_end.append(np.max(self.ioa_with_anchors(anchor_xmin[jdx],anchor_xmax[jdx],gt_end_bboxs[:,0],gt_end_bboxs[:,1])))
-
-            action_gt = action_gt + match_score_action
-            starting_gt = starting_gt + match_score_start
-            ending_gt = ending_gt  + match_score_end
-
-
-        action_gt = torch.Tensor(action_gt)
-        starting_gt = torch.Tensor(starting_gt)
-        ending_gt = torch.Tensor(ending_gt)
+        # F T x N
+        gt_xmins=gt_segment[:,0]/level_ratio
+        gt_xmaxs=gt_segment[:,1]/level_ratio
+
+        gt_lens=gt_xmaxs-gt_xmins
+        gt_len_small=torch.clamp(0.1*gt_lens, min=1)
+
+        ##################################### Gaussian centerness label ############################################
+        # anchors inside a gt take the centerness w.r.t. the last such gt, others 0.1
+        gt_center = (gt_xmins+gt_xmaxs)/2
+        inside = (anchor_xmin >= gt_xmins) & (anchor_xmin <= gt_xmaxs)
+        gt_idx = torch.arange(num_gts, device=gt_segment.device)
+        last_gt = (inside * gt_idx).argmax(dim=1, keepdim=True)
+        distance_cen = torch.abs(anchor_xmin[:, 0] - gt_center.gather(1, last_gt)[:, 0])
+        # scalar constant, folded outside of the tensor ops
+        inv_two_sigma2 = 1.0 / (2*args.cen_gau_sigma*args.cen_gau_sigma)
+        centerness_value = torch.exp(distance_cen.square_().mul_(-inv_two_sigma2))
+        action_gt = torch.where(
+            inside.any(dim=1), centerness_value, torch.full_like(centerness_value, 0.1))
+        ###################################################################################################
+
+        # max ioa with the start / end regions of the gts: F T x N -> F T
+        starting_gt = self.ioa_with_anchors(
+            anchor_xmin, anchor_xmax, gt_xmins-gt_len_small/2, gt_xmins+gt_len_small/2).amax(dim=1)
+        ending_gt = self.ioa_with_anchors(
+            anchor_xmin, anchor_xmax, gt_xmaxs-gt_len_small/2, gt_xmaxs+gt_len_small/2).amax(dim=1)
 
         return cls_targets_v, cls_targets_n, reg_targets, starting_gt, ending_gt, action_gt
 
@@ -1211,15 +1570,16 @@ class PtTransformer(nn.Module):
         out_cls_logits_v, out_cls_logits_n, out_offsets, out_conf,
         gt_cls_labels_v, gt_cls_labels_n, gt_offsets, gt_start, gt_end, gt_action, out_actionness_audio, is_audio = True
     ):
-        # fpn_masks, out_*: F (List) [B, T_i, C]
-        # gt_* : B (list) [F T, C]
+        # fpn_masks: F (List) [B, T_i]
+        # out_*, gt_* : [B, F T, C]
         # fpn_masks -> (B, FT)
+        # (the masks come from the neck and are small bool tensors)
         valid_mask = torch.cat(fpn_masks, dim=1)
 
         # 1. classification loss
         # stack the list -> (B, FT) -> (# Valid, )
-        gt_cls_v = torch.stack(gt_cls_labels_v)
-        gt_cls_n = torch.stack(gt_cls_labels_n)
+        gt_cls_v = gt_cls_labels_v
+        gt_cls_n = gt_cls_labels_n
         pos_mask = (gt_cls_n >= 0) & (gt_cls_n != self.num_classes_noun) &(gt_cls_v >= 0) & (gt_cls_v != self.num_classes_verb) & valid_mask
 
         # shape of out_offsets = (6, 2, T (2304, 1152, ..., 72),2)
@@ -1229,60 +1589,42 @@ class PtTransformer(nn.Module):
         # cat the predicted offsets -> (B, FT, 2 (xC)) -> # (#Pos, 2 (xC))
 
         if is_audio == False:
-            pred_offsets = torch.cat(out_offsets, dim=1)[pos_mask]
-            pred_conf = torch.cat(out_conf, dim=1)[pos_mask]
-            out_actionness_audio = torch.cat(out_actionness_audio, dim=1)[pos_mask]
+            # (the head outputs are bf16 under autocast, the losses are in fp32)
+            pred_offsets = out_offsets[pos_mask].float()
+            pred_conf = out_conf[pos_mask].float()
+            out_actionness_audio = out_actionness_audio[pos_mask].float()
         #out_actionness_audio = out_actionness_audio.squeeze()
         # shape of pred_offsets = (6, 2, T (2304, 1152, ..., 72),2) ---> (2, 4536, 2)
         # shape of pred_offsets = (6, 2, T (2304, 1152, ..., 72),1) ---> (2, 4536, 2)
 
 
-        gt_offsets = torch.stack(gt_offsets)[pos_mask]
-        gt_start = torch.stack(gt_start)[pos_mask]
-        gt_end = torch.stack(gt_end)[pos_mask]
-        gt_action = torch.stack(gt_action)[pos_mask]
+        gt_offsets = gt_offsets[pos_mask]
+        gt_start = gt_start[pos_mask]
+        gt_end = gt_end[pos_mask]
+        gt_action = gt_action[pos_mask]
 
         # update the loss normalizer
-        num_pos = pos_mask.sum().item()
+        # (the masked gather above already knows #pos on the host)
+        num_pos = gt_offsets.shape[0]
         self.loss_normalizer = self.loss_normalizer_momentum * self.loss_normalizer + (
             1 - self.loss_normalizer_momentum
-        ) * max(num_pos, 1)
+        ) * pos_mask.sum().clamp(min=1)
 
         ############################## verb ##############################
-        # #cls + 1 (background)
-        gt_target_v = F.one_hot(
-            gt_cls_v[valid_mask], num_classes=self.num_classes_verb + 1
-        )[:, :-1]
-        gt_target_v = gt_target_v.to(out_cls_logits_v[0].dtype)
-
-        # optinal label smoothing
-        gt_target_v *= 1 - self.train_label_smoothing
-        gt_target_v += self.train_label_smoothing / (self.num_classes_verb + 1)
-
-        # focal loss
-        cls_loss_v = sigmoid_focal_loss(
-            torch.cat(out_cls_logits_v, dim=1)[valid_mask],
-            gt_target_v,
-            reduction='sum'
+        # focal loss on the (smoothed) one-hot targets, #cls + 1 (background)
+        cls_loss_v = sigmoid_focal_loss_with_labels(
+            out_cls_logits_v[valid_mask],
+            gt_cls_v[valid_mask],
+            float(self.train_label_smoothing)
         )
         cls_loss_v /= 250#self.loss_normalizer
 
         ############################## noun ##############################
-        # #cls + 1 (background)
-        gt_target_n = F.one_hot(
-            gt_cls_n[valid_mask], num_classes=self.num_classes_noun + 1
-        )[:, :-1]
-        gt_target_n = gt_target_n.to(out_cls_logits_n[0].dtype)
-
-        # optinal label smoothing
-        gt_target_n *= 1 - self.train_label_smoothing
-        gt_target_n += self.train_label_smoothing / (self.num_classes_noun + 1)
-
-        # focal loss
-        cls_loss_n = sigmoid_focal_loss(
-            torch.cat(out_cls_logits_n, dim=1)[valid_mask],
-            gt_target_n,
-            reduction='sum'
+        # focal loss on the (smoothed) one-hot targets, #cls + 1 (background)
+        cls_loss_n = sigmoid_focal_loss_with_labels(
+            out_cls_logits_n[valid_mask],
+            gt_cls_n[valid_mask],
+            float(self.train_label_smoothing)
         )
         cls_loss_n /= 500#self.loss_normalizer
 
@@ -1332,7 +1674,8 @@ class PtTransformer(nn.Module):
     ):
         # video_list B (list) [dict]
         # points F (list) [T_i, 4]
-        # fpn_masks, out_*: F (List) [B, T_i, C]
+        # fpn_masks: F (List) [B, T_i]
+        # out_*: [B, F T, C]
         results = []
 
         # 1: gather video meta information
@@ -1348,17 +1691,17 @@ class PtTransformer(nn.Module):
             zip(vid_idxs, vid_fps, vid_lens, vid_ft_stride, vid_ft_nframes)
         ):
             ################################# visual #######################################
-            cls_logits_per_vid_verb_visual = [x[idx] for x in out_cls_logits_verb_visual]
-            cls_logits_per_vid_noun_visual = [x[idx] for x in out_cls_logits_noun_visual]
-            offsets_per_vid_visual = [x[idx] for x in out_offsets_visual]
-            conf_per_vid_visual = [x[idx] for x in out_conf_visual]
+            cls_logits_per_vid_verb_visual = out_cls_logits_verb_visual[idx]
+            cls_logits_per_vid_noun_visual = out_cls_logits_noun_visual[idx]
+            offsets_per_vid_visual = out_offsets_visual[idx]
+            conf_per_vid_visual = out_conf_visual[idx]
             fpn_masks_per_vid_visual = [x[idx] for x in fpn_masks_visual]
 
 
             ################################# audio #######################################
-            cls_logits_per_vid_verb_audio = [x[idx] for x in out_cls_logits_verb_audio]
-            cls_logits_per_vid_noun_audio = [x[idx] for x in out_cls_logits_noun_audio]
-            actionness = [x[idx] for x in out_cls_logits_actionness_audio]
+            cls_logits_per_vid_verb_audio = out_cls_logits_verb_audio[idx]
+            cls_logits_per_vid_noun_audio = out_cls_logits_noun_audio[idx]
+            actionness = out_cls_logits_actionness_audio[idx]
 
             
             # offsets_per_vid_audio = [x[idx] for x in out_offsets_audio]
@@ -1382,6 +1725,10 @@ class PtTransformer(nn.Module):
 
 
         # step 3: postprocssing
+        if self.defer_postprocessing:
+            # start the host copies now, return the (host only) rest of the
+            # postprocessing as a callable, e.g., for a worker thread
+            return functools.partial(self.postprocessing_host, results, *self.postprocessing_device(results))
         results = self.postprocessing(results)
 
 
@@ -1396,142 +1743,224 @@ class PtTransformer(nn.Module):
         fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_actionness
     ):
         # points F (list) [T_i, 4]
-        # fpn_masks, out_*: F (List) [T_i, C]
-        segs_all = []
-        scores_all = []
-        scores_cls = []
-        scores_start = []
-        scores_end = []       
-        cls_idxs_verb_all = []
-        cls_idxs_noun_all = []
-        level=0
-        # loop over fpn levels
-        for pts_i, mask_i, cls_i_verb_visual, cls_i_noun_visual, offsets_i, out_conf_i, mask_i_audio, cls_i_verb_audio, cls_i_noun_audio, actionness_i in zip(
-            points, fpn_masks_visual, out_cls_logits_verb_visual, out_cls_logits_noun_visual, out_offsets_visual, out_conf_visual, fpn_masks_audio, out_cls_logits_verb_audio, out_cls_logits_noun_audio, out_actionness):
-            level = level+1
-
-            input_conf_s = torch.exp(torch.div(-torch.square(out_conf_i[:, 0]),2*args.gau_sigma*args.gau_sigma))
-            input_conf_e = torch.exp(torch.div(-torch.square(out_conf_i[:, 1]),2*args.gau_sigma*args.gau_sigma))
- 
-            conf_s = input_conf_s.sigmoid().cpu()
-            conf_e = input_conf_e.sigmoid().cpu()
-
-            gt_val_s_i_new = [conf_s[min(len(conf_s)-1,max(0,int(x - offsets_i[x][0])))] for x in range(len(conf_s))]
-            gt_val_s_i = torch.Tensor(gt_val_s_i_new)#.sigmoid()
-            gt_val_e_i_new = [conf_e[min(len(conf_e)-1,max(0,int(x + offsets_i[x][1])))] for x in range(len(conf_e))]
-            gt_val_e_i = torch.Tensor(gt_val_e_i_new)#.sigmoid()
-
-            if len(gt_val_s_i) < len(pts_i):
-                gt_val_s_i = torch.cat((gt_val_s_i,torch.zeros(len(pts_i)-len(gt_val_s_i))),0)
-            if len(gt_val_e_i) < len(pts_i):
-                gt_val_e_i = torch.cat((gt_val_e_i,torch.zeros(len(pts_i)-len(gt_val_e_i))),0)
-
-
-            cls_i_verb = cls_i_verb_visual + 0.2*cls_i_verb_audio + args.actionness_ratio * actionness_i.repeat(1,97) + 0.3*(gt_val_s_i+gt_val_e_i).cuda().unsqueeze(1).repeat(1,97)
-            cls_i_noun = cls_i_noun_visual + 0.2*cls_i_noun_audio + args.actionness_ratio * actionness_i.repeat(1,300) + 0.3*(gt_val_s_i+gt_val_e_i).cuda().unsqueeze(1).repeat(1,300)
-
-            cls_verb_score, cls_verb_label = torch.sort(cls_i_verb.sigmoid(),descending=True,dim=1)  #torch.max(cls_i_verb.sigmoid(), 1)
-            cls_noun_score, cls_noun_label = torch.sort(cls_i_noun.sigmoid(),descending=True,dim=1) #torch.max(cls_i_noun.sigmoid(), 1)
-
-            verb_topk, noun_topk = 11, 33
-            cls_verb_score_topk = cls_verb_score[:,:verb_topk]* mask_i.unsqueeze(-1)
-            cls_verb_label_topk = cls_verb_label[:,:verb_topk]* mask_i.unsqueeze(-1)
-
-            cls_noun_score_topk = cls_noun_score[:,:noun_topk]* mask_i.unsqueeze(-1)
-            cls_noun_label_topk = cls_noun_label[:,:noun_topk]* mask_i.unsqueeze(-1)
-
-            action_label_all = []
-
-            mul_cls_score = torch.mul(cls_noun_score_topk.unsqueeze(dim=-1),cls_verb_score_topk.unsqueeze(dim=1))# * mask_i.unsqueeze(-1).unsqueeze(-1)
-            pred_prob = mul_cls_score.flatten() #cls_noun_score*cls_verb_score#*cls_noun_score#cls_verb_score * cls_noun_score
-
-
-            # Apply filtering to make NMS faster following detectron2
-            # 1. Keep seg with confidence score > a threshold
-            keep_idxs1 = (pred_prob > self.test_pre_nms_thresh * self.test_pre_nms_thresh)
-            pred_prob = pred_prob[keep_idxs1]
-            topk_idxs = keep_idxs1.nonzero(as_tuple=True)[0]
-
-            # 2. Keep top k top scoring boxes only
-            num_topk = min(self.test_pre_nms_topk, topk_idxs.size(0))
-            pred_prob, idxs = pred_prob.sort(descending=True)
-            pred_prob = pred_prob[:num_topk].clone()
-            topk_idxs = topk_idxs[idxs[:num_topk]].clone()
-
-
-            # fix a warning in pytorch 1.9
-
-            ########################### for multiply verb and noun scores #########################
-
-            pt_idxs =  torch.div(
-                topk_idxs, verb_topk*noun_topk, rounding_mode='floor'
-            )
-            dx_loc = torch.fmod(topk_idxs, verb_topk*noun_topk)
-
-            cls_noun_idxs1 = torch.div(dx_loc, verb_topk, rounding_mode='floor')
-            cls_verb_idxs1 = torch.fmod(dx_loc, verb_topk)
-
-            cls_noun_idxs = cls_noun_label_topk[pt_idxs,cls_noun_idxs1]
-            cls_verb_idxs = cls_verb_label_topk[pt_idxs,cls_verb_idxs1]
-            #####################################################################################3
-
-            # 3. gather predicted offsets
-            offsets = offsets_i[pt_idxs]
-            pts = pts_i[pt_idxs]
-
-            # 4. compute predicted segments (denorm by stride for output offsets)
-            seg_left = pts[:, 0] - offsets[:, 0] * pts[:, 3]
-            seg_right = pts[:, 0] + offsets[:, 1] * pts[:, 3]
-            pred_segs = torch.stack((seg_left, seg_right), -1)
-
-            # 5. Keep seg with duration > a threshold (relative to feature grids)
-            seg_areas = seg_right - seg_left
-            keep_idxs2 = seg_areas > self.test_duration_thresh
-
-            segs_all.append(pred_segs[keep_idxs2])
-            scores_all.append(pred_prob[keep_idxs2])
-
-            cls_idxs_verb_all.append(cls_verb_idxs[keep_idxs2])
-            cls_idxs_noun_all.append(cls_noun_idxs[keep_idxs2])
-
-        # cat along the FPN levels (F N_i, C)
-
-        segs_all, scores_all, cls_idxs_verb_all, cls_idxs_noun_all = [
-            torch.cat(x) for x in [segs_all, scores_all, cls_idxs_verb_all, cls_idxs_noun_all]
-        ]
-        cls_idxs_action_all = []
-
-
-        results = {'segments' : segs_all,
-                   'scores'   : scores_all,
-                   'labels_verb'   : cls_idxs_verb_all,
-                   'labels_noun'   : cls_idxs_noun_all}
+        # fpn_masks: F (List) [T_i]
+        # out_*: [F T, C]
+        # all levels are processed at once on their concatenation (F T, C),
+        # only the per-level top k candidates are selected level by level
+        lens = [pts_i.shape[0] for pts_i in points]
+        pts_all = self.point_generator.concat(points)
+        level_start, level_last = self.fpn_level_index(lens, pts_all.device)
+        mask_all = torch.cat(fpn_masks_visual)
+        offsets_all = out_offsets_visual
+        conf_all = out_conf_visual
+        actionness_all = out_actionness
+
+        # Gaussian start / end conf (both columns at once)
+        # scalar constant, folded outside of the tensor ops
+        inv_two_sigma2 = 1.0 / (2*args.gau_sigma*args.gau_sigma)
+        input_conf = torch.exp(conf_all.square().mul_(-inv_two_sigma2))
+        conf_s, conf_e = input_conf.sigmoid_().unbind(1)
+
+        # start / end conf at the boundaries predicted by each point, clamped
+        # to the level of the point (a single gather on the device, int()
+        # truncation = .long())
+        anchor_x = (torch.arange(len(conf_s), device=offsets_all.device) - level_start).to(offsets_all.dtype)
+        idx_s = (anchor_x - offsets_all[:, 0]).long().clamp_(min=0)
+        idx_e = (anchor_x + offsets_all[:, 1]).long().clamp_(min=0)
+        idx_s = torch.minimum(idx_s, level_last).add_(level_start)
+        idx_e = torch.minimum(idx_e, level_last).add_(level_start)
+        gt_val_s = conf_s[idx_s]
+        gt_val_e = conf_e[idx_e]
+
+        # T x 1 actionness / boundary scores (shared by verbs / nouns),
+        # broadcast over the classes, no T x C intermediates
+        shared = (gt_val_s + gt_val_e).unsqueeze(1).mul_(0.3).add_(actionness_all, alpha=args.actionness_ratio)
+        cls_verb = torch.add(
+            out_cls_logits_verb_visual, out_cls_logits_verb_audio, alpha=0.2).add_(shared)
+        cls_noun = torch.add(
+            out_cls_logits_noun_visual, out_cls_logits_noun_audio, alpha=0.2).add_(shared)
+
+        # top k verbs / nouns of each point (sorted), topk instead of a full
+        # sort of all classes, and the sigmoid (monotonic) on the top k only.
+        # Only this noun_topk x verb_topk block of the N x V products is
+        # formed; the (i, j)-th pair is beaten by the (i+1)(j+1) pairs of
+        # higher ranks of its point, so ranks beyond pre_nms_topk never make
+        # it into the top k of a level
+        verb_topk = min(11, self.test_pre_nms_topk)
+        noun_topk = min(33, self.test_pre_nms_topk)
+        cls_verb_score, cls_verb_label = torch.topk(cls_verb, verb_topk, dim=1, sorted=True)
+        cls_noun_score, cls_noun_label = torch.topk(cls_noun, noun_topk, dim=1, sorted=True)
+
+        cls_verb_score_topk = cls_verb_score.sigmoid_()* mask_all.unsqueeze(-1)
+        cls_verb_label_topk = cls_verb_label* mask_all.unsqueeze(-1)
+
+        cls_noun_score_topk = cls_noun_score.sigmoid_()* mask_all.unsqueeze(-1)
+        cls_noun_label_topk = cls_noun_label* mask_all.unsqueeze(-1)
+
+        # F T x (noun_topk x verb_topk), (optionally) in bf16
+        cls_noun_score_topk = cls_noun_score_topk.to(self.test_score_dtype)
+        cls_verb_score_topk = cls_verb_score_topk.to(self.test_score_dtype)
+        mul_cls_score = torch.mul(cls_noun_score_topk.unsqueeze(dim=-1),cls_verb_score_topk.unsqueeze(dim=1))
+        pred_prob_all = mul_cls_score.flatten(1)
+        num_cands = pred_prob_all.shape[1]
+
+        # Apply filtering to make NMS faster following detectron2
+        # 1. Keep top k top scoring boxes of each level only (a single topk
+        # over the candidates of a level, no nonzero + full sort)
+        # the top k of each level are written into its slice of a single
+        # preallocated output (no per-level tensors / cat)
+        num_topk = [min(self.test_pre_nms_topk, n * num_cands) for n in lens]
+        pred_prob = pred_prob_all.new_empty(sum(num_topk))
+        topk_idxs = torch.empty(sum(num_topk), dtype=torch.long, device=pred_prob_all.device)
+        st, out_st = 0, 0
+        for n, k in zip(lens, num_topk):
+            prob_i, idxs_i = pred_prob[out_st:out_st + k], topk_idxs[out_st:out_st + k]
+            torch.topk(pred_prob_all[st:st + n].flatten(), k, sorted=True, out=(prob_i, idxs_i))
+            idxs_i.add_(st * num_cands)
+            st += n
+            out_st += k
+        pred_prob = pred_prob.float()
+
+        # 2. Keep seg with confidence score > a threshold
+        keep_idxs1 = pred_prob > self.test_pre_nms_thresh_sq
+        pred_prob = pred_prob[keep_idxs1]
+        topk_idxs = topk_idxs[keep_idxs1]
+        # no candidate left (the size is known after the masking anyway),
+        # skip the label lookup / decoding
+        if pred_prob.numel() == 0:
+            device = pred_prob.device
+            return {'segments' : torch.empty((0, 2), device=device),
+                    'scores'   : pred_prob,
+                    'labels_verb'   : torch.empty((0,), dtype=torch.long, device=device),
+                    'labels_noun'   : torch.empty((0,), dtype=torch.long, device=device)}
+
+        ########################### for multiply verb and noun scores #########################
+
+        pt_idxs, cls_noun_idxs1, cls_verb_idxs1 = unravel_action_index(topk_idxs, noun_topk, verb_topk)
+
+        # single gather at the flat (row-major) index of each label
+        cls_noun_idxs = torch.take(cls_noun_label_topk, pt_idxs * noun_topk + cls_noun_idxs1)
+        cls_verb_idxs = torch.take(cls_verb_label_topk, pt_idxs * verb_topk + cls_verb_idxs1)
+        #####################################################################################3
+
+        # 3. gather predicted offsets
+        offsets = offsets_all[pt_idxs]
+        pts = pts_all[pt_idxs]
+
+        # 4. compute predicted segments (denorm by stride for output offsets)
+        # 5. Keep seg with duration > a threshold (relative to feature grids)
+        pred_segs, keep_idxs2 = decode_segments(pts, offsets, self.test_duration_thresh)
+
+        # F N_i, in the order of the levels
+        results = {'segments' : pred_segs[keep_idxs2],
+                   'scores'   : pred_prob[keep_idxs2],
+                   'labels_verb'   : cls_verb_idxs[keep_idxs2],
+                   'labels_noun'   : cls_noun_idxs[keep_idxs2]}
 
 
         return results
 
-
+    def fpn_level_index(self, lens, device):
+        """
+            First index / last index within the level of every point of the
+            concatenated levels (F T, ), cached for the last level lengths
+        """
+        key = (tuple(lens), device)
+        if self.level_index_cache is None or self.level_index_cache[0] != key:
+            level_start, level_last = [], []
+            st = 0
+            for n in lens:
+                level_start.append(torch.full((n,), st, dtype=torch.long, device=device))
+                level_last.append(torch.full((n,), n - 1, dtype=torch.long, device=device))
+                st += n
+            self.level_index_cache = (key, torch.cat(level_start), torch.cat(level_last))
+        return self.level_index_cache[1:]
 
     @torch.no_grad()
     def postprocessing(self, results):
         # input : list of dictionary items
         # (1) push to CPU; (2) NMS; (3) convert to actual time stamps
-        processed_results = []
+        return self.postprocessing_host(results, *self.postprocessing_device(results))
+
+    @torch.no_grad()
+    def postprocessing_device(self, results):
+        """
+            Device part of the postprocessing: (optional) nms on the device and
+            async copies of the results to the host. Return the packed host
+            results and the cuda event of the copies (None on cpu)
+        """
+        # 0: hard nms directly on the device (if available), only the kept
+        # segs are copied to the host
+        device_nms = (self.test_nms_method == 'hard') and HAS_DEVICE_NMS
+        if device_nms:
+            for results_per_vid in results:
+                if results_per_vid['scores'].numel() == 0:
+                    continue
+                (results_per_vid['segments'], results_per_vid['scores'],
+                 results_per_vid['labels_verb'], results_per_vid['labels_noun']) = batched_nms_device(
+                    results_per_vid['segments'], results_per_vid['scores'],
+                    results_per_vid['labels_verb'], results_per_vid['labels_noun'],
+                    self.test_iou_threshold,
+                    self.test_min_score,
+                    self.test_max_seg_num,
+                    multiclass = self.test_multiclass_nms,
+                    num_classes_noun = self.num_classes_noun,
+                    voting_thresh = self.test_voting_thresh
+                )
+
+        # 1: move the results of all videos to CPU, packed as N x 5
+        # (segs, score, verb, noun) such that each video needs a single
+        # async copy into pinned memory, and wait for all of them once
+        packed_results = []
+        copy_done = None
         for results_per_vid in results:
+            scores = results_per_vid['scores']
+            # nothing to copy for a video without candidates
+            if scores.numel() == 0:
+                packed_results.append(torch.empty((0, 5), dtype=scores.dtype))
+                continue
+            packed = torch.cat((
+                results_per_vid['segments'],
+                scores[:, None],
+                results_per_vid['labels_verb'][:, None].to(scores.dtype),
+                results_per_vid['labels_noun'][:, None].to(scores.dtype)
+            ), dim=1).detach()
+            if packed.is_cuda:
+                packed_cpu = torch.empty(packed.shape, dtype=packed.dtype, pin_memory=True)
+                packed_cpu.copy_(packed, non_blocking=True)
+                copy_done = torch.cuda.Event()
+                copy_done.record(torch.cuda.current_stream(packed.device))
+                packed = packed_cpu
+            packed_results.append(packed)
+        return packed_results, copy_done
+
+    @torch.no_grad()
+    def postprocessing_host(self, results, packed_results, copy_done):
+        """
+            Host part of the postprocessing (see postprocessing_device): wait
+            for the copies, nms on the cpu and convert to actual time stamps.
+            Does not launch any work on the device (can run on another thread)
+        """
+        if copy_done is not None:
+            copy_done.synchronize()
+
+        device_nms = (self.test_nms_method == 'hard') and HAS_DEVICE_NMS
+        processed_results = []
+        for results_per_vid, packed in zip(results, packed_results):
             # unpack the meta info
             vidx = results_per_vid['video_id']
             fps = results_per_vid['fps']
             vlen = results_per_vid['duration']
             stride = results_per_vid['feat_stride']
             nframes = results_per_vid['feat_num_frames']
-            # 1: unpack the results and move to CPU
-            segs = results_per_vid['segments'].detach().cpu()
-            scores = results_per_vid['scores'].detach().cpu()
-            labels_verb = results_per_vid['labels_verb'].detach().cpu()
-            labels_noun = results_per_vid['labels_noun'].detach().cpu()
+            # unpack the results (class ids are exact in floating point)
+            segs = packed[:, :2].contiguous()
+            scores = packed[:, 2].contiguous()
+            labels_verb = packed[:, 3].long()
+            labels_noun = packed[:, 4].long()
             #labels_action = results_per_vid['labels_action']#.detach().cpu()
-            if self.test_nms_method != 'none':
-                # 2: batched nms (only implemented on CPU)
+            if self.test_nms_method != 'none' and not device_nms and segs.shape[0] > 0:
+                # 2: batched nms (soft nms only implemented on CPU)
 
                 segs, scores, labels_verb, labels_noun = batched_nms(
                     segs, scores, labels_verb, labels_noun,
@@ -1541,15 +1970,15 @@ class PtTransformer(nn.Module):
                     use_soft_nms = (self.test_nms_method == 'soft'),
                     multiclass = self.test_multiclass_nms,
                     sigma = self.test_nms_sigma,
-                    voting_thresh = self.test_voting_thresh
+                    voting_thresh = self.test_voting_thresh,
+                    num_classes_noun = self.num_classes_noun
                 )
             # 3: convert from feature grids to seconds
             if segs.shape[0] > 0:
 
                 segs = (segs * stride + 0.5 * nframes) / fps
                 # truncate all boundaries within [0, duration]
-                segs[segs<=0.0] *= 0.0
-                segs[segs>=vlen] = segs[segs>=vlen] * 0.0 + vlen
+                segs.clamp_(min=0.0, max=float(vlen))
 
             #4: repack the results
             processed_results.append(
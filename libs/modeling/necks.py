@@ -80,14 +80,14 @@ class FPN1D(nn.Module):
 
         # fpn conv / norm -> outputs
         # mask will remain the same
-        fpn_feats = tuple()
+        fpn_feats = []
         for i in range(used_backbone_levels):
             x, _ = self.fpn_convs[i](
                 laterals[i], fpn_masks[i + self.start_level])
             x = self.fpn_norms[i](x)
-            fpn_feats += (x, )
+            fpn_feats.append(x)
 
-        return fpn_feats, fpn_masks
+        return tuple(fpn_feats), fpn_masks
 
 @register_neck('identity')
 class FPNIdentity(nn.Module):
@@ -134,6 +134,6 @@ class FPNIdentity(nn.Module):
         fpn_feats = []
         for i in range(len(self.fpn_norms)):
             x = self.fpn_norms[i](inputs[i + self.start_level])
-            fpn_feats += (x, )
+            fpn_feats.append(x)
 
-        return fpn_feats, fpn_masks
+        return tuple(fpn_feats), fpn_masks
@@ -1,10 +1,10 @@
-from .nms import batched_nms
+from .nms import batched_nms, batched_nms_device, HAS_DEVICE_NMS
 from .metrics import ANETdetection
 from .train_utils import (make_optimizer, make_scheduler, save_checkpoint,
-                          AverageMeter, train_one_epoch, valid_one_epoch,
-                          fix_random_seed, ModelEma)
+                          AsyncCheckpointer, AverageMeter, train_one_epoch,
+                          valid_one_epoch, fix_random_seed, ModelEma)
 from .postprocessing import postprocess_results
 
-__all__ = ['batched_nms', 'make_optimizer', 'make_scheduler', 'save_checkpoint',
-           'AverageMeter', 'train_one_epoch', 'valid_one_epoch', 'ANETdetection',
+__all__ = ['batched_nms', 'batched_nms_device', 'HAS_DEVICE_NMS', 'make_optimizer', 'make_scheduler', 'save_checkpoint',
+           'AsyncCheckpointer', 'AverageMeter', 'train_one_epoch', 'valid_one_epoch', 'ANETdetection',
            'postprocess_results', 'fix_random_seed', 'ModelEma']
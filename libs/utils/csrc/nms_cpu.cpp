@@ -168,15 +168,18 @@ Tensor softnms_1d(Tensor segs, Tensor scores, Tensor dets, float iou_threshold,
   return softnms_1d_cpu(segs, scores, dets, iou_threshold, sigma, min_score, method);
 }
 
-// bind to torch interface
+// bind to torch interface (no python objects are touched, release the GIL
+// such that the nms on a worker thread does not stall the main thread)
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def(
     "nms", &nms_1d, "nms (CPU) ",
-    py::arg("segs"), py::arg("scores"), py::arg("iou_threshold")
+    py::arg("segs"), py::arg("scores"), py::arg("iou_threshold"),
+    py::call_guard<py::gil_scoped_release>()
   );
   m.def(
     "softnms", &softnms_1d, "softnms (CPU) ",
     py::arg("segs"), py::arg("scores"), py::arg("dets"), py::arg("iou_threshold"),
-    py::arg("sigma"), py::arg("min_score"), py::arg("method")
+    py::arg("sigma"), py::arg("min_score"), py::arg("method"),
+    py::call_guard<py::gil_scoped_release>()
   );
 }
@@ -5,6 +5,13 @@ import sys
 sys.path.append(".")
 import nms_1d_cpu
 
+# on-device (cuda) hard nms kernel, optional
+try:
+    from torchvision.ops import batched_nms as _tv_batched_nms
+    HAS_DEVICE_NMS = True
+except ImportError:
+    HAS_DEVICE_NMS = False
+
 
 class NMSop(torch.autograd.Function):
     @staticmethod
@@ -33,7 +40,8 @@ class NMSop(torch.autograd.Function):
         sorted_segs = segs[inds]
         sorted_scores = scores[inds]
         sorted_cls_idxs = cls_idxs[inds]
-        return sorted_segs.clone(), sorted_scores.clone(), sorted_cls_idxs.clone()
+        # (indexing already returns new tensors, no clone needed)
+        return sorted_segs, sorted_scores, sorted_cls_idxs
 
 
 class SoftNMSop(torch.autograd.Function):
@@ -64,7 +72,8 @@ class SoftNMSop(torch.autograd.Function):
         sorted_cls_idxs_verb = sorted_cls_idxs_verb[:n_segs]
         sorted_cls_idxs_noun = cls_idxs_noun[inds]
         sorted_cls_idxs_noun = sorted_cls_idxs_noun[:n_segs]
-        return sorted_segs.clone(), sorted_scores.clone(), sorted_cls_idxs_verb.clone(), sorted_cls_idxs_noun.clone()
+        # dets is local to this call, its views need no clone
+        return sorted_segs, sorted_scores, sorted_cls_idxs_verb, sorted_cls_idxs_noun
 
 
 def seg_voting(nms_segs, all_segs, all_scores, iou_threshold, score_offset=1.5):
@@ -116,6 +125,7 @@ def batched_nms(
     multiclass=True,
     sigma=0.5,
     voting_thresh=0.75,
+    num_classes_noun=300,
 ):
     # Based on Detectron2 implementation,
     num_segs = segs.shape[0]
@@ -132,18 +142,8 @@ def batched_nms(
 
 
 
-        label_v_n = [str(v)+','+str(n) for v in range(0,97) for n in range(0,300)]
-        label_v_n_idx = range(0,len(label_v_n))
-
-        label_action_dict = dict(zip(label_v_n, label_v_n_idx))
-        label_action_dict_opp = dict(zip(label_v_n_idx, label_v_n))
-
-
-        cls_idxs_action = []
-        for i in range(len(cls_idxs_verb)):
-            action_cls = str(int(cls_idxs_verb[i].cpu())) + ',' + str(int(cls_idxs_noun[i].cpu()))
-            cls_idxs_action.append(label_action_dict[action_cls])
-        cls_idxs_action = torch.Tensor(cls_idxs_action)
+        # action id of each (verb, noun) pair: verb * #nouns + noun
+        cls_idxs_action = cls_idxs_verb * num_classes_noun + cls_idxs_noun
 
         for class_id in torch.unique(cls_idxs_action):
             curr_indices = torch.where(cls_idxs_action == class_id)[0]
@@ -161,14 +161,17 @@ def batched_nms(
                     max_seg_num
                 )
             else:
-                sorted_segs, sorted_scores, sorted_cls_idxs = NMSop.apply(
+                # the kept (input) indices, to gather the verbs / nouns
+                sorted_segs, sorted_scores, kept_indices = NMSop.apply(
                     segs[curr_indices],
+                    curr_indices,
                     scores[curr_indices],
-                    cls_idxs[curr_indices],
                     iou_threshold,
                     min_score,
                     max_seg_num
                 )
+                sorted_cls_idxs_verb = cls_idxs_verb[kept_indices]
+                sorted_cls_idxs_noun = cls_idxs_noun[kept_indices]
             # disable seg voting for multiclass nms, no sufficient segs
 
             # fill in the class index
@@ -193,10 +196,12 @@ def batched_nms(
                 sigma, min_score, 2, max_seg_num
             )
         else:
-            new_segs, new_scores, new_cls_idxs = NMSop.apply(
-                segs, scores, cls_idxs, iou_threshold,
+            new_segs, new_scores, kept_indices = NMSop.apply(
+                segs, torch.arange(num_segs), scores, iou_threshold,
                 min_score, max_seg_num
             )
+            new_cls_idxs_verb = cls_idxs_verb[kept_indices]
+            new_cls_idxs_noun = cls_idxs_noun[kept_indices]
         # seg voting
         if voting_thresh > 0:
             new_segs = seg_voting(
@@ -219,3 +224,47 @@ def batched_nms(
     new_cls_idxs_verb = new_cls_idxs_verb[idxs[:max_seg_num]]
     new_cls_idxs_noun = new_cls_idxs_noun[idxs[:max_seg_num]]
     return new_segs, new_scores, new_cls_idxs_verb, new_cls_idxs_noun
+
+
+def batched_nms_device(
+    segs,
+    scores,
+    cls_idxs_verb,
+    cls_idxs_noun,
+    iou_threshold,
+    min_score,
+    max_seg_num,
+    multiclass=True,
+    num_classes_noun=300,
+    voting_thresh=0.75,
+):
+    """
+        Hard nms on the device of the inputs (torchvision.ops.batched_nms, see
+        HAS_DEVICE_NMS), such that only the kept segs are copied to the host.
+        The 1D segs are nms-ed as boxes of unit height (same iou), and the
+        (verb, noun) pairs are the classes of multiclass nms.
+        Same outputs as batched_nms(use_soft_nms=False)
+    """
+    all_segs, all_scores = segs, scores
+    # vanilla nms will not change the score, so we can filter segs first
+    if min_score > 0:
+        valid_mask = scores > min_score
+        segs, scores = segs[valid_mask], scores[valid_mask]
+        cls_idxs_verb, cls_idxs_noun = cls_idxs_verb[valid_mask], cls_idxs_noun[valid_mask]
+
+    zeros = torch.zeros_like(segs[:, 0])
+    boxes = torch.stack((segs[:, 0], zeros, segs[:, 1], zeros + 1), dim=-1)
+    if multiclass:
+        cls_idxs_action = cls_idxs_verb * num_classes_noun + cls_idxs_noun
+    else:
+        cls_idxs_action = torch.zeros_like(cls_idxs_verb)
+    # kept inds, sorted by descending score
+    inds = _tv_batched_nms(boxes, scores, cls_idxs_action, float(iou_threshold))
+    if max_seg_num > 0:
+        inds = inds[:max_seg_num]
+
+    new_segs = segs[inds]
+    # seg voting (class agnostic only, as in batched_nms)
+    if (not multiclass) and (voting_thresh > 0) and (new_segs.shape[0] > 0):
+        new_segs = seg_voting(new_segs, all_segs, all_scores, voting_thresh)
+    return new_segs, scores[inds], cls_idxs_verb[inds], cls_idxs_noun[inds]
@@ -6,6 +6,7 @@ import json
 import numpy as np
 import random
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 # from torchinfo import summary
 # from torchviz import make_dot
 import torch
@@ -42,8 +43,7 @@ def fix_random_seed(seed, include_cuda=True):
 def save_checkpoint(state, is_best, file_folder,
                     file_name='checkpoint.pth.tar'):
     """save checkpoint to file"""
-    if not os.path.exists(file_folder):
-        os.mkdir(file_folder)
+    os.makedirs(file_folder, exist_ok=True)
     torch.save(state, os.path.join(file_folder, file_name))
     if is_best:
         # skip the optimization / scheduler state
@@ -52,6 +52,63 @@ def save_checkpoint(state, is_best, file_folder,
         torch.save(state, os.path.join(file_folder, 'model_best.pth.tar'))
 
 
+class AsyncCheckpointer(object):
+    """
+        save_checkpoint on a background thread: the states are first copied
+        into pinned cpu buffers (allocated once, reused for every checkpoint),
+        so training can move on while the file is written
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _snapshot(self, obj, key, devices):
+        if torch.is_tensor(obj):
+            if obj.is_cuda:
+                devices.add(obj.device)
+            buf = self.buffers.get(key)
+            if (buf is None) or (buf.shape != obj.shape) or (buf.dtype != obj.dtype):
+                buf = torch.empty(obj.shape, dtype=obj.dtype,
+                                  pin_memory=torch.cuda.is_available())
+                self.buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, key + (k,), devices)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,), devices) for i, v in enumerate(obj))
+        return deepcopy(obj)
+
+    def _write(self, state, events, is_best, file_folder, file_name):
+        for event in events:
+            event.synchronize()
+        save_checkpoint(state, is_best, file_folder, file_name)
+
+    def save(self, state, is_best, file_folder, file_name='checkpoint.pth.tar'):
+        # the buffers are reused, wait for the previous write to finish
+        self.wait()
+        devices = set()
+        state = self._snapshot(state, (), devices)
+        # the async copies run on the current stream of each source device
+        events = []
+        for device in devices:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(device))
+            events.append(event)
+        self.pending = self.executor.submit(
+            self._write, state, events, is_best, file_folder, file_name)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
 def print_model_params(model):
     for name, param in model.named_parameters():
         print(name, param.min().item(), param.max().item(), param.mean().item())
@@ -88,6 +145,9 @@ def make_optimizer(model, optimizer_config):
             elif pn.endswith('rel_pe'):
                 # corner case for relative position encoding
                 no_decay.add(fpn)
+            elif pn.endswith('scales'):
+                # corner case of the per-level scales of the heads
+                no_decay.add(fpn)
 
     # validate that we considered every parameter
     param_dict = {pn: p for pn, p in model.named_parameters()}
@@ -257,9 +317,11 @@ def train_one_epoch(
     model_ema = None,
     clip_grad_l2norm = -1,
     tb_writer = None,
-    print_freq = 20
+    print_freq = 20,
+    amp = False,
+    is_main = True
 ):
-    """Training the model for one epoch"""
+    """Training the model for one epoch (logging on the main process only)"""
     # set up meters
     batch_time = AverageMeter()
     losses_tracker = {}
@@ -269,7 +331,8 @@ def train_one_epoch(
     model.train()
 
     # main training loop
-    print("\n[Train]: Epoch {:d} started".format(curr_epoch))
+    if is_main:
+        print("\n[Train]: Epoch {:d} started".format(curr_epoch))
     start = time.time()
     for iter_idx, video_list in enumerate(train_loader, 0):
         # zero out optim
@@ -277,7 +340,9 @@ def train_one_epoch(
         # print('===================================================================')
         # print(video_list)
         # forward / backward the model
-        losses = model(video_list, args)
+        # bf16 autocast needs no loss scaling
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=amp):
+            losses = model(video_list, args)
         losses['final_loss'].backward()
         # gradient cliping (to stabilize training if necessary)
         if clip_grad_l2norm > 0.0:
@@ -293,7 +358,7 @@ def train_one_epoch(
             model_ema.update(model)
 
         # printing (only check the stats when necessary to avoid extra cost)
-        if (iter_idx != 0) and (iter_idx % print_freq) == 0:
+        if is_main and (iter_idx != 0) and (iter_idx % print_freq) == 0:
             # measure elapsed time (sync all kernels)
             torch.cuda.synchronize()
             batch_time.update((time.time() - start) / print_freq)
@@ -356,7 +421,8 @@ def train_one_epoch(
 
     # finish up and print
     lr = scheduler.get_last_lr()[0]
-    print("[Train]: Epoch {:d} finished with lr={:.8f}\n".format(curr_epoch, lr))
+    if is_main:
+        print("[Train]: Epoch {:d} finished with lr={:.8f}\n".format(curr_epoch, lr))
 
     return
 
@@ -383,9 +449,14 @@ def valid_one_epoch(
     output_file = None,
     tb_writer = None,
     print_freq = 20,
-    dataset = None
+    dataset = None,
+    amp = False,
+    async_postprocessing = False
 ):
-    """Test the model on the validation set"""
+    """Test the model on the validation set
+    async_postprocessing: the model defers its cpu postprocessing (see
+    PtTransformer.defer_postprocessing), which then runs on a worker thread
+    """
     # either evaluate the results or save the results
     #assert (evaluator_verb is not None) or (output_file is not None)
 
@@ -411,38 +482,59 @@ def valid_one_epoch(
     # loop over validation set
     start = time.time()
     results_all= {} 
-    for iter_idx, video_list in enumerate(val_loader, 0):
 
-        with torch.no_grad():
+    def collect_results(output):
+        num_vids = len(output)
 
+        for vid_idx in range(num_vids):
 
-            output = model(video_list,args)
-            num_vids = len(output)
-           
-            for vid_idx in range(num_vids):
 
+        #################################### for testing json #########################################
 
-            #################################### for testing json #########################################
+            seg_num = output[vid_idx]['segments'].shape[0]
 
-                seg_num = output[vid_idx]['segments'].shape[0]
+            results_save_per_vid = []
 
-                results_save_per_vid = []
+            for seg_idx in range(seg_num):
 
-                for seg_idx in range(seg_num):
+                results_save_per_seg = {}
+                results_save_per_seg["verb"]=int(output[vid_idx]['labels_verb'][seg_idx])
+                results_save_per_seg["noun"]=int(output[vid_idx]['labels_noun'][seg_idx])
+                results_save_per_seg["action"]=str(int(output[vid_idx]['labels_verb'][seg_idx]))+","+str(int(output[vid_idx]['labels_noun'][seg_idx]))
+                results_save_per_seg["score"]=float(output[vid_idx]['scores'][seg_idx])
+                results_save_per_seg["segment"]=[float(output[vid_idx]['segments'][seg_idx][0]),float(output[vid_idx]['segments'][seg_idx][1])]
+                results_save_per_vid += (results_save_per_seg, )
 
-                    results_save_per_seg = {}
-                    results_save_per_seg["verb"]=int(output[vid_idx]['labels_verb'][seg_idx])
-                    results_save_per_seg["noun"]=int(output[vid_idx]['labels_noun'][seg_idx])
-                    results_save_per_seg["action"]=str(int(output[vid_idx]['labels_verb'][seg_idx]))+","+str(int(output[vid_idx]['labels_noun'][seg_idx]))
-                    results_save_per_seg["score"]=float(output[vid_idx]['scores'][seg_idx])
-                    results_save_per_seg["segment"]=[float(output[vid_idx]['segments'][seg_idx][0]),float(output[vid_idx]['segments'][seg_idx][1])]
-                    results_save_per_vid += (results_save_per_seg, )
+            results_all[output[vid_idx]['video_id']] = results_save_per_vid
 
-                results_all[output[vid_idx]['video_id']] = results_save_per_vid
 
+        ###########################################################################################
 
-            ###########################################################################################
+    # overlap the cpu nms of a batch with the forward pass of the next one:
+    # the model returns the host part of its postprocessing as a callable
+    # (see PtTransformer.postprocessing_device), run on a worker thread
+    # (the callables can not be gathered by nn.DataParallel across gpus)
+    executor, pending = None, None
+    if async_postprocessing:
+        assert len(getattr(model, 'device_ids', [None])) == 1, \
+            "async postprocessing requires a single gpu"
+        executor = ThreadPoolExecutor(max_workers=1)
+    model_without_dp = model.module if hasattr(model, 'module') else model
+    model_without_dp.defer_postprocessing = async_postprocessing
+    for iter_idx, video_list in enumerate(val_loader, 0):
 
+        with torch.no_grad():
+
+
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=amp):
+                output = model(video_list,args)
+            if executor is not None:
+                future = executor.submit(output)
+                if pending is not None:
+                    collect_results(pending.result())
+                pending = future
+            else:
+                collect_results(output)
 
 
         # printing
@@ -458,6 +550,12 @@ def valid_one_epoch(
                   iter_idx, len(val_loader), batch_time=batch_time))
             #break
 
+    if pending is not None:
+        collect_results(pending.result())
+    if executor is not None:
+        executor.shutdown()
+    model_without_dp.defer_postprocessing = False
+
     output_dict = {"version": "0.2", "challenge": "action_detection","sls_pt": 2,"sls_tl": 3,"sls_td": 3,"results":results_all}
     results_json_path = './outputs/test.json'
     with open(results_json_path, "w") as json_file_out:
@@ -0,0 +1,42 @@
+# python imports
+import argparse
+import os
+
+# our code
+from libs.core import load_config
+from libs.datasets import make_dataset
+
+
+################################################################################
+def main(args):
+    """pre-transpose / downsample all feats into a fp16 C x T cache"""
+    if os.path.isfile(args.config):
+        cfg = load_config(args.config)
+    else:
+        raise ValueError("Config file does not exist.")
+    if args.cache_folder is not None:
+        cfg['dataset']['cache_folder'] = args.cache_folder
+    if cfg['dataset']['cache_folder'] is None:
+        raise ValueError("No cache folder given (config or --cache-folder).")
+
+    # building the datasets fills in the cache (existing files are skipped)
+    for is_training, split in ((True, cfg['train_split']), (False, cfg['val_split'])):
+        dataset = make_dataset(
+            cfg['dataset_name'], is_training, split, cfg['init_rand_seed'], **cfg['dataset']
+        )
+        print("Cached {:d} videos of {} in {}".format(
+            len(dataset), split, cfg['dataset']['cache_folder']))
+
+
+################################################################################
+if __name__ == '__main__':
+    """Entry Point"""
+    # the arg parser
+    parser = argparse.ArgumentParser(
+      description='Cache the feats as pre-transposed fp16 arrays')
+    parser.add_argument('config', type=str, metavar='DIR',
+                        help='path to a config file')
+    parser.add_argument('--cache-folder', default=None, type=str,
+                        help='folder for the cached feats (default: dataset.cache_folder)')
+    args = parser.parse_args()
+    main(args)
@@ -2,13 +2,14 @@
 import argparse
 import os
 import time
-import datetime
 from pprint import pprint
 import random
 # torch imports
 import torch
 import torch.nn as nn
 import torch.utils.data
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
 # for visualization
 #from torch.utils.tensorboard import SummaryWriter
@@ -18,7 +19,7 @@ from libs.core import load_config
 from libs.datasets import make_dataset, make_data_loader
 from libs.modeling import make_meta_arch
 from libs.utils import (train_one_epoch, valid_one_epoch, ANETdetection,
-                        save_checkpoint, make_optimizer, make_scheduler,
+                        AsyncCheckpointer, make_optimizer, make_scheduler,
                         fix_random_seed, ModelEma)
 
 
@@ -33,21 +34,35 @@ def main(args):
         cfg = load_config(args.config)
     else:
         raise ValueError("Config file does not exist.")
-    pprint(cfg)
+
+    # one process per gpu when launched with torchrun (nccl all-reduce),
+    # otherwise fall back to nn.DataParallel over cfg['devices']
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        world_size = dist.get_world_size()
+        is_main = dist.get_rank() == 0
+    else:
+        world_size = len(cfg['devices'])
+        is_main = True
+    if is_main:
+        pprint(cfg)
 
     # prep for output folder (based on time stamp)
-    if not os.path.exists(cfg['output_folder']):
-        os.mkdir(cfg['output_folder'])
+    if is_main:
+        os.makedirs(cfg['output_folder'], exist_ok=True)
     cfg_filename = os.path.basename(args.config).replace('.yaml', '')
     if len(args.output) == 0:
-        ts = datetime.datetime.fromtimestamp(int(time.time()))
+        ts = time.strftime('%Y%m%d_%H%M%S')
         ckpt_folder = os.path.join(
             cfg['output_folder'], cfg_filename + '_' + str(ts))
     else:
         ckpt_folder = os.path.join(
             cfg['output_folder'], cfg_filename + '_' + str(args.output))
-    if not os.path.exists(ckpt_folder):
-        os.mkdir(ckpt_folder)
+    if is_main:
+        os.makedirs(ckpt_folder, exist_ok=True)
     # tensorboard writer
     #tb_writer = SummaryWriter(os.path.join(ckpt_folder, 'logs'))
 
@@ -58,9 +73,23 @@ def main(args):
     #rng_generator = random.seed(a=None, version=2)
 
 
+    # trade the deterministic kernels for cudnn autotuning (the data order is
+    # still fixed by rng_generator, which the sampler requires on the cpu)
+    if cfg['train_cfg']['cudnn_benchmark']:
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.deterministic = False
+        torch.use_deterministic_algorithms(False)
+
+    # TF32 matmuls / convs (does not affect determinism, only precision)
+    if cfg['train_cfg']['allow_tf32']:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
     # re-scale learning rate / # workers based on number of GPUs
-    cfg['opt']["learning_rate"] *= len(cfg['devices'])
-    cfg['loader']['num_workers'] *= len(cfg['devices'])
+    # (with DDP each process already runs its own loader workers)
+    cfg['opt']["learning_rate"] *= world_size
+    if not distributed:
+        cfg['loader']['num_workers'] *= world_size
 
     """2. create dataset / dataloader"""
     train_dataset = make_dataset(
@@ -74,24 +103,49 @@ def main(args):
 
 
     # data loaders
+    train_sampler = None
+    if distributed:
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            train_dataset, shuffle=True, seed=args.training_seed, drop_last=True)
     train_loader = make_data_loader(
-        train_dataset, True, rng_generator, **cfg['loader'])
+        train_dataset, True, rng_generator, sampler=train_sampler,
+        **cfg['loader'])
     
 
     """3. create model, optimizer, and scheduler"""
     # model
     model = make_meta_arch(cfg['model_name'], **cfg['model'])
-    # not ideal for multi GPU training, ok for now
-    model = nn.DataParallel(model, device_ids=cfg['devices'])
+    # enable model EMA
+    if is_main:
+        print("Using model EMA ...")
+    if distributed:
+        model = model.cuda(local_rank)
+        # DDP can not be deep-copied, wrap the EMA copy with DataParallel to
+        # keep the 'module.' keys expected by eval.py
+        model_ema = ModelEma(nn.DataParallel(model, device_ids=[local_rank]))
+        # reg_head_audio is built (and kept for the checkpoints / init) but
+        # never called, hence find_unused_parameters. The buffers (loss
+        # normalizer, anchor / mask tables) need no broadcast per forward
+        model = DistributedDataParallel(
+            model, device_ids=[local_rank],
+            find_unused_parameters=True, broadcast_buffers=False)
+    else:
+        # not ideal for multi GPU training, ok for now
+        model = nn.DataParallel(model, device_ids=cfg['devices'])
+        model_ema = ModelEma(model)
     # optimizer
     optimizer = make_optimizer(model, cfg['opt'])
     # schedule
     num_iters_per_epoch = len(train_loader)
     scheduler = make_scheduler(optimizer, cfg['opt'], num_iters_per_epoch)
 
-    # enable model EMA
-    print("Using model EMA ...")
-    model_ema = ModelEma(model)
+    # compile the training model (after the EMA copy, single gpu or DDP)
+    if cfg['train_cfg']['compile_mode'] is not None:
+        if distributed or len(cfg['devices']) == 1:
+            model.module.compile_modules(cfg['train_cfg']['compile_mode'])
+        else:
+            if is_main:
+                print("torch.compile is not supported with nn.DataParallel, skipped.")
 
     """4. Resume from model / Misc"""
     # resume from a checkpoint?
@@ -100,27 +154,30 @@ def main(args):
             # load ckpt, reset epoch / best rmse
             checkpoint = torch.load(args.resume,
                 map_location = lambda storage, loc: storage.cuda(
-                    cfg['devices'][0]))
+                    local_rank if distributed else cfg['devices'][0]))
             args.start_epoch = checkpoint['epoch'] + 1
             model.load_state_dict(checkpoint['state_dict'])
             model_ema.module.load_state_dict(checkpoint['state_dict_ema'])
             # also load the optimizer / scheduler if necessary
             optimizer.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
-            print("=> loaded checkpoint '{:s}' (epoch {:d}".format(
-                args.resume, checkpoint['epoch']
-            ))
+            if is_main:
+                print("=> loaded checkpoint '{:s}' (epoch {:d}".format(
+                    args.resume, checkpoint['epoch']
+                ))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
             return
 
     # save the current config
-    with open(os.path.join(ckpt_folder, 'config.txt'), 'w') as fid:
-        pprint(cfg, stream=fid)
-        fid.flush()
+    if is_main:
+        with open(os.path.join(ckpt_folder, 'config.txt'), 'w') as fid:
+            pprint(cfg, stream=fid)
+            fid.flush()
 
     """4. training / validation loop"""
-    print("\nStart training model {:s} ...".format(cfg['model_name']))
+    if is_main:
+        print("\nStart training model {:s} ...".format(cfg['model_name']))
 
     # start training
     max_epochs = cfg['opt'].get(
@@ -128,9 +185,13 @@ def main(args):
         cfg['opt']['epochs'] + cfg['opt']['warmup_epochs']
     )
 
+    # checkpoints are written in the background of the next epoch
+    checkpointer = AsyncCheckpointer()
     for epoch in range(args.start_epoch, max_epochs):
         if epoch == args.stop_save_epoch:
             break
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         # train for one epoch
         train_one_epoch(
             args,
@@ -142,11 +203,13 @@ def main(args):
             model_ema = model_ema,
             clip_grad_l2norm = cfg['train_cfg']['clip_grad_l2norm'],
             tb_writer=None,
-            print_freq=args.print_freq
+            print_freq=args.print_freq,
+            amp=cfg['train_cfg']['amp'],
+            is_main=is_main
         )
 
         # save ckpt once in a while
-        if (
+        if is_main and (
             (epoch == max_epochs - 1) or
             (
                 (args.ckpt_freq > 0) and
@@ -162,7 +225,7 @@ def main(args):
             }
 
             save_states['state_dict_ema'] = model_ema.module.state_dict()
-            save_checkpoint(
+            checkpointer.save(
                 save_states,
                 False,
                 file_folder=ckpt_folder,
@@ -170,8 +233,12 @@ def main(args):
             )
 
     # wrap up
+    checkpointer.close()
     #tb_writer.close()
-    print("All done!")
+    if distributed:
+        dist.destroy_process_group()
+    if is_main:
+        print("All done!")
     return
 
 
@@ -228,10 +295,12 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     ############################## print args #############################
-    print('############################ User-defined parameter ############################')
-    for k, v in sorted(vars(args).items()):
-        print(k, ' = ', v)
-    print('############################ User-defined parameter ############################')
+    # (once, on rank 0 under torchrun)
+    if int(os.environ.get('RANK', 0)) == 0:
+        print('############################ User-defined parameter ############################')
+        for k, v in sorted(vars(args).items()):
+            print(k, ' = ', v)
+        print('############################ User-defined parameter ############################')
 
     main(args)
 